@@ -0,0 +1,162 @@
+import collections
+import copy
+import csv
+import sys
+import threading
+
+import requests
+
+import books
+import googlebooks
+import isbns
+import utilities
+
+
+Result = collections.namedtuple("Result", ["action", "identifier", "detail", "document"])
+
+# What a lookup and cover download can reasonably fail with: the network, the filesystem, a response that doesn't
+# parse, or nothing found. Anything else is a bug, and should say so.
+RESOLVE_ERRORS = (requests.RequestException, OSError, ValueError, utilities.BookNotFound, books.InvalidBook)
+
+
+def read_lines(values, stream=None):
+    if values:
+        yield from values
+        return
+    for line in stream or sys.stdin:
+        line = line.strip()
+        if line and not line.startswith("#"):
+            yield line
+
+
+def keys(book):
+    # Everything a request might name the book by, including its ISBNs in the form `resolve` looks them up in.
+    yield from books.identifiers(book)
+    yield from isbns.book_isbns(book)
+
+
+def index(library):
+    return {key: book for book in library for key in keys(book)}
+
+
+def apply_status(path, document, status):
+    # Returns a copy of the document on the new shelf. Some shelves need dates the book may not have (abandoning a
+    # book that was never started, say), and those raise InvalidBook rather than writing a book that won't load.
+    book = books.Book(path, document=utilities.Document(content=document.content,
+                                                        metadata=copy.deepcopy(document.metadata)))
+    book.status = status
+    try:
+        books.validate(book)
+    except books.InvalidBook:
+        raise books.InvalidBook(f"can't be '{status.value[0]}' without the dates it needs")
+    return book.document
+
+
+class Importer(object):
+
+    def __init__(self, storage, directory, layout="flat", jobs=8, batch_size=100):
+        self.storage = storage
+        self.directory = directory
+        self.layout = layout
+        self.jobs = jobs
+        self.batch_size = batch_size
+        self.known = index(storage.load())
+        self.lock = threading.Lock()
+        self.claimed = set()
+
+    def claim(self, *keys):
+        # Requests for the same book would download its cover to the same path at the same time, so only the first
+        # one in gets to add it.
+        with self.lock:
+            if any(key in self.claimed for key in keys):
+                return False
+            self.claimed.update(keys)
+            return True
+
+    def resolve(self, request):
+        # `status` is the name of a shelf, or None. Results are reported against the ISBN as given.
+        isbn, status = request
+        value = isbns.normalize(isbn)
+        if value is None:
+            return Result("failed", isbn, "not a valid ISBN", None)
+        if value in self.known:
+            return Result("skipped", isbn, f"already in the library as '{self.known[value].title}'", None)
+        if status is not None:
+            if status not in books.STATUS_NAMES:
+                return Result("failed", isbn, f"unknown status '{status}'", None)
+            status = books.STATUS_NAMES[status]
+            # New books have no dates, so this can be checked before anything's downloaded.
+            try:
+                apply_status(isbn, utilities.Document(content="", metadata={"title": isbn}), status)
+            except books.InvalidBook as e:
+                return Result("failed", isbn, str(e), None)
+        if not self.claim(value):
+            return Result("skipped", isbn, "duplicate request", None)
+        try:
+            new_book = googlebooks.search_isbn(value)
+            if new_book.id in self.known:
+                return Result("skipped", isbn, f"already in the library as '{self.known[new_book.id].title}'", None)
+            if not self.claim(new_book.id, new_book.basename):
+                return Result("skipped", isbn, f"same book as an earlier request ('{new_book.title}')", None)
+            path, document = books.prepare_book(self.directory, new_book, layout=self.layout)
+        except utilities.BookNotFound:
+            return Result("failed", isbn, "not found", None)
+        except RESOLVE_ERRORS as e:
+            return Result("failed", isbn, str(e) or e.__class__.__name__, None)
+        if status is not None:
+            document = apply_status(path, document, status)
+        return Result("added", isbn, path, document)
+
+    def run(self, requests):
+        # Lookups and cover downloads run concurrently; writes happen here, on one thread, a batch at a time.
+        batch = []
+        for result in utilities.bounded_map(self.resolve, requests, workers=self.jobs):
+            if result.document is not None:
+                book = books.Book(result.detail, document=result.document)
+                self.known.update({key: book for key in keys(book)})
+                batch.append((result.detail, result.document))
+                if len(batch) >= self.batch_size:
+                    self.storage.write_many(batch)
+                    batch = []
+            yield result
+        if batch:
+            self.storage.write_many(batch)
+
+
+def csv_requests(stream):
+    for row in csv.DictReader(stream):
+        row = {key.strip().lower(): value.strip() for key, value in row.items() if key is not None and value}
+        isbn = row.get("isbn13") or row.get("isbn_13") or row.get("isbn")
+        if not isbn:
+            continue
+        yield isbn, row.get("status")
+
+
+def set_status(storage, identifiers, status):
+    known = index(storage.load())
+    results = []
+    changed = []
+    for identifier in identifiers:
+        book = known.get(identifier)
+        if book is None:
+            results.append(Result("missing", identifier, "not in the library", None))
+            continue
+        try:
+            apply_status(book.path, book.document, status)
+        except books.InvalidBook as e:
+            results.append(Result("failed", identifier, str(e), None))
+            continue
+        book.status = status
+        changed.append(book)
+        results.append(Result("updated", identifier, book.path, book.document))
+    storage.save_many(changed)
+    return results
+
+
+def print_results(results):
+    counts = collections.Counter()
+    for result in results:
+        counts[result.action] += 1
+        print(f"{result.action}\t{result.identifier}\t{result.detail}", flush=True)
+    sys.stderr.write(", ".join(f"{count} {action}" for action, count in sorted(counts.items())) + "\n")
+    return counts
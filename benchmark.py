@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+
+import argparse
+import http.server
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+
+import frontmatter
+
+import books
+import codec
+import googlebooks
+import utilities
+
+
+WORDS = ["the", "night", "circus", "house", "of", "leaves", "station", "eleven", "name", "wind", "left", "hand",
+         "darkness", "sea", "tranquility", "library", "midnight", "piranesi", "dune", "foundation", "empire", "glass",
+         "city", "river", "garden", "silent", "stars", "winter", "summer", "ghost", "machine", "kingdom"]
+# Modules that must not be imported before the picker is first drawn.
+DEFERRED_MODULES = ["requests", "urllib3", "googlebooks", "numpy", "jinja2", "webbrowser", "PIL", "sqlite3", "lxml"]
+# About twice what importing bookshelf takes on a laptop today.
+IMPORT_BUDGET = 100.0
+
+NAMES = ["Ursula Le Guin", "Emily St. John Mandel", "Susanna Clarke", "Frank Herbert", "Isaac Asimov", "Iain Banks",
+         "Ann Leckie", "Ted Chiang", "Octavia Butler", "Becky Chambers", "Mark Danielewski", "Erin Morgenstern"]
+
+
+def cover_data(size):
+    # Not a decodable image, but the right shape and size for anything that only moves covers around.
+    return b"\xff\xd8\xff\xe0" + random.randbytes(max(size - 6, 0)) + b"\xff\xd9"
+
+
+def generate_library(directory, count, cover_size=16384, seed=0):
+    random.seed(seed)
+    cover = cover_data(cover_size)
+    os.makedirs(directory, exist_ok=True)
+    for index in range(count):
+        title = " ".join(random.choice(WORDS) for _ in range(random.randint(1, 5))).title()
+        author = random.choice(NAMES)
+        basename = f"{utilities.basename(f'{title} {author}')}-{index}"
+        metadata = {
+            "title": title,
+            "authors": [author],
+            "category": "books",
+            "ids": {
+                "google_books": f"synthetic{index}",
+                "isbn_13": f"978{index:010d}",
+            },
+            "thumbnail": f"{basename}-cover.jpg",
+        }
+        status = random.choice(["to-read", "currently-reading", "read", "abandoned"])
+        metadata["status"] = status
+        start = utilities.tznow().replace(year=random.randint(2000, 2023), month=random.randint(1, 12), day=1)
+        if status in ("currently-reading", "read", "abandoned"):
+            metadata["date"] = start.isoformat()
+        if status in ("read", "abandoned"):
+            metadata["end_date"] = start.replace(day=random.randint(2, 28)).isoformat()
+        with open(os.path.join(directory, metadata["thumbnail"]), "wb") as fh:
+            fh.write(cover)
+        codec.write(os.path.join(directory, f"{basename}.md"), utilities.Document(content="", metadata=metadata))
+
+
+class GoogleBooksStub(object):
+
+    def __init__(self, latency=0.0, page_size=10, cover_size=16384):
+        self.latency = latency
+        self.page_size = page_size
+        self.cover = cover_data(cover_size)
+        self.server = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    def volume(self, title, index):
+        identifier = f"stub{index}"
+        return {
+            "kind": "books#volume",
+            "id": identifier,
+            "volumeInfo": {
+                "title": f"{title} {index}",
+                "subtitle": "A Synthetic Volume",
+                "authors": [NAMES[index % len(NAMES)]],
+                "language": "en",
+                "canonicalVolumeLink": f"{self.url}/books?id={identifier}",
+                "imageLinks": {
+                    "thumbnail": f"{self.url}/covers/{identifier}.jpg?zoom=1",
+                },
+                "industryIdentifiers": [
+                    {"type": "ISBN_10", "identifier": f"{index:010d}"},
+                    {"type": "ISBN_13", "identifier": f"978{index:010d}"},
+                ],
+            },
+        }
+
+    def volumes(self, parameters):
+        query = parameters.get("q", [""])[0]
+        if query.startswith("isbn:"):
+            # Synthetic ISBN-13s are '978' followed by the volume's index.
+            index = int(query[len("isbn:"):][-10:])
+            return {"kind": "books#volumes", "totalItems": 1, "items": [self.volume(WORDS[index % len(WORDS)].title(), index)]}
+        start = int(parameters.get("startIndex", ["0"])[0])
+        count = min(int(parameters.get("maxResults", [str(self.page_size)])[0]), 40)
+        return {
+            "kind": "books#volumes",
+            "totalItems": 1000,
+            "items": [self.volume(query.title(), index) for index in range(start, start + count)],
+        }
+
+    def __enter__(self):
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                time.sleep(stub.latency)
+                url = urllib.parse.urlparse(self.path)
+                if url.path == "/books/v1/volumes":
+                    body = json.dumps(stub.volumes(urllib.parse.parse_qs(url.query))).encode("utf-8")
+                    content_type = "application/json"
+                elif url.path.startswith("/covers/"):
+                    body = stub.cover
+                    content_type = "image/jpeg"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class Context(object):
+
+    def __init__(self, library_path, sample, stub):
+        self.library_path = library_path
+        self.sample = sample
+        self.stub = stub
+        self._library = None
+        self._texts = None
+
+    @property
+    def library(self):
+        if self._library is None:
+            self._library = books.load(self.library_path)
+        return self._library
+
+    @property
+    def texts(self):
+        if self._texts is None:
+            self._texts = []
+            for book in self.library:
+                with open(book.path) as fh:
+                    self._texts.append(fh.read())
+        return self._texts
+
+
+def benchmark_load(context):
+    books.load(context.library_path)
+
+
+def benchmark_summary(context):
+    for book in context.library:
+        book.summary
+
+
+def benchmark_type_ahead(context):
+    picker = utilities.SearchablePicker(options=context.library,
+                                        title="Bookshelf",
+                                        options_map_func=lambda x: x.summary)
+    # Type the start of the last title so every key press has to scan the whole library.
+    for character in context.library[-1].summary.lower()[:8]:
+        if ord(character) in picker.custom_handlers:
+            picker.custom_handlers[ord(character)](picker)
+
+
+def benchmark_parse(context):
+    for text in context.texts:
+        codec.loads(text)
+
+
+def benchmark_serialise(context):
+    for book in context.library:
+        codec.dumps(book.document)
+
+
+def benchmark_save(context):
+    for book in context.library[:context.sample]:
+        book.save()
+
+
+def benchmark_search(context):
+    for index in range(min(context.sample, 20)):
+        googlebooks.search(query=f"{random.choice(WORDS)} {random.choice(WORDS)}")
+
+
+def benchmark_import_book(context):
+    results = googlebooks.search(query="import")
+    with tempfile.TemporaryDirectory() as directory:
+        for new_book in results:
+            books.import_book(directory, new_book)
+
+
+BENCHMARKS = {
+    "load": benchmark_load,
+    "summary": benchmark_summary,
+    "type_ahead": benchmark_type_ahead,
+    "parse": benchmark_parse,
+    "serialise": benchmark_serialise,
+    "save": benchmark_save,
+    "search": benchmark_search,
+    "import_book": benchmark_import_book,
+}
+
+
+def measure(function, context, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(context)
+        timings.append(time.perf_counter() - start)
+
+    # Tracing allocations slows everything down, so peak memory gets a run of its own.
+    tracemalloc.start()
+    function(context)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "seconds": timings,
+        "min": min(timings),
+        "median": statistics.median(timings),
+        "peak_memory": peak,
+    }
+
+
+def import_times(module):
+    # `-X importtime` reports the time spent importing each module (and everything it imports) in microseconds.
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                             cwd=os.path.dirname(os.path.abspath(__file__)),
+                             capture_output=True,
+                             text=True,
+                             check=True)
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def measure_startup(repeat):
+    runs = [import_times("bookshelf") for _ in range(repeat)]
+    seconds = [times["bookshelf"] / 1000000.0 for times in runs]
+    return {
+        "seconds": seconds,
+        "min": min(seconds),
+        "median": statistics.median(seconds),
+        "deferred_modules_imported": [module for module in DEFERRED_MODULES if module in runs[0]],
+    }
+
+
+def check_startup(startup, budget):
+    failures = []
+    if startup["deferred_modules_imported"]:
+        failures.append(f"Startup imports {', '.join(startup['deferred_modules_imported'])}.")
+    if budget and startup["median"] * 1000 > budget:
+        failures.append(f"Startup imports took {startup['median'] * 1000:.1f} ms (budget {budget:.1f} ms).")
+    return failures
+
+
+def compare(results, baseline):
+    print(f"{'Benchmark':16}{'Baseline':>12}{'Current':>12}{'Change':>10}")
+    before_results = dict(baseline["benchmarks"], startup=baseline.get("startup"))
+    for name, result in dict(results["benchmarks"], startup=results["startup"]).items():
+        if before_results.get(name) is None:
+            continue
+        before = before_results[name]["median"]
+        after = result["median"]
+        change = (after - before) / before * 100 if before else 0.0
+        print(f"{name:16}{before:12.4f}{after:12.4f}{change:+9.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the bookshelf hot paths.")
+    parser.add_argument("--books", "-n", type=int, default=1000, help="number of books in the synthetic library")
+    parser.add_argument("--library", help="reuse (or create) the synthetic library at this path")
+    parser.add_argument("--latency", type=float, default=0.0, help="Google Books stub latency in milliseconds")
+    parser.add_argument("--sample", type=int, default=100, help="number of books to save and queries to run")
+    parser.add_argument("--repeat", "-r", type=int, default=3, help="number of timed runs per benchmark")
+    parser.add_argument("--only", action="append", choices=list(BENCHMARKS.keys()), help="run only this benchmark")
+    parser.add_argument("--output", "-o", help="write the results to this JSON file")
+    parser.add_argument("--compare", "-c", help="compare against the results in this JSON file")
+    parser.add_argument("--import-budget", type=float, default=IMPORT_BUDGET,
+                        help=f"fail if importing bookshelf takes longer than this many milliseconds (default "
+                             f"{IMPORT_BUDGET:.0f}, 0 to disable)")
+    options = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        library_path = os.path.abspath(options.library or os.path.join(temporary_directory, "library"))
+        if not os.path.exists(library_path):
+            sys.stderr.write(f"Generating {options.books} books in '{library_path}'...\n")
+            generate_library(library_path, options.books)
+
+        with GoogleBooksStub(latency=options.latency / 1000.0) as stub:
+            googlebooks.API_URL = f"{stub.url}/books/v1/volumes"
+            context = Context(library_path=library_path, sample=options.sample, stub=stub)
+            results = {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "books": len(context.library),
+                "latency": options.latency,
+                "yaml": {"loader": frontmatter.default_handlers.SafeLoader.__name__,
+                         "dumper": frontmatter.default_handlers.SafeDumper.__name__},
+                "benchmarks": {},
+            }
+            results["startup"] = measure_startup(options.repeat)
+            for name, function in BENCHMARKS.items():
+                if options.only and name not in options.only:
+                    continue
+                sys.stderr.write(f"Running {name}...\n")
+                results["benchmarks"][name] = measure(function, context, options.repeat)
+
+    output = json.dumps(results, indent=4)
+    if options.output:
+        with open(options.output, "w") as fh:
+            fh.write(output)
+            fh.write("\n")
+    else:
+        print(output)
+
+    if options.compare:
+        with open(options.compare) as fh:
+            compare(results, json.load(fh))
+
+    failures = check_startup(results["startup"], options.import_budget)
+    if failures:
+        exit("\n".join(failures))
+
+
+if __name__ == "__main__":
+    main()
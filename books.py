@@ -1,15 +1,20 @@
+import copy
 import curses
 import enum
+import hashlib
 import json
+import math
 import os
 import subprocess
 import tempfile
-import webbrowser
 
-import dateutil
-import frontmatter
 import pick
+import yaml
 
+import codec
+import covers
+import isbns
+import profiling
 import utilities
 
 
@@ -22,6 +27,15 @@ class Status(enum.Enum):
     ABANDONED_UNKNOWN = ("abandoned", "Abandoned, Unknown", lambda x: x.date is None and x.end_date is None)
 
 
+STATUS_NAMES = {status.name.lower().replace("_", "-"): status for status in Status}
+
+
+class Sort(enum.Enum):
+    TITLE = ("Title", lambda x: x.title)
+    START_DATE = ("Started", lambda x: (x.start_time is None, -(x.start_time or 0), x.title))
+    END_DATE = ("Finished", lambda x: (x.end_time is None, -(x.end_time or 0), x.title))
+
+
 def clear_start_date(book):
     book.date = None
 
@@ -48,18 +62,94 @@ STATUS_TRANSFORMS = {
 }
 
 
+class InvalidBook(Exception):
+    pass
+
+
 def get_status(book):
     for status in list(Status):
         if status.value[0] == book.raw_status and status.value[2](book):
             return status
-    exit(f"Unable to determine status for '{book.title}'.")
+    raise InvalidBook(f"Unable to determine status for '{book.path}'.")
+
+
+def flat_shard(basename, metadata):
+    return ""
+
+
+def letter_shard(basename, metadata):
+    return basename[:1] if basename[:1].isalnum() else "_"
+
+
+def year_shard(basename, metadata):
+    date = metadata.get("end_date") or metadata.get("date")
+    return str(date)[:4] if date is not None else "undated"
+
+
+LAYOUTS = {
+    "flat": flat_shard,
+    "letter": letter_shard,
+    "year": year_shard,
+}
+
+
+class ConflictError(Exception):
+    pass
+
+
+MISSING = object()
+
+# Everything reading and checking a single book can throw for a damaged file.
+LOAD_ERRORS = (InvalidBook, OSError, ValueError, TypeError, KeyError, AttributeError, yaml.YAMLError)
+
+
+def snapshot(document):
+    # Enough of a copy to notice changes made through the book later on; values are only ever replaced or edited one
+    # level down (`ids`, `authors`).
+    metadata = {key: copy.copy(value) for key, value in document.metadata.items()}
+    return utilities.Document(content=document.content, metadata=metadata)
+
+
+def is_unchanged(document, base):
+    return document.metadata == base.metadata and document.content == base.content
+
+
+def merge_value(name, base, ours, theirs):
+    if ours == theirs or theirs == base:
+        return ours
+    if ours == base:
+        return theirs
+    raise ConflictError(f"'{name}' was changed both here and on disk.")
+
+
+def merge(base, ours, theirs):
+    # Three-way merge of front matter, key by key, taking whichever side changed each value.
+    metadata = {}
+    for key in list(ours.metadata) + [key for key in theirs.metadata if key not in ours.metadata]:
+        value = merge_value(key,
+                            base.metadata.get(key, MISSING),
+                            ours.metadata.get(key, MISSING),
+                            theirs.metadata.get(key, MISSING))
+        if value is not MISSING:
+            metadata[key] = value
+    content = merge_value("content", base.content, ours.content, theirs.content)
+    return utilities.Document(content=content, metadata=metadata)
 
 
 class Book(object):
 
-    def __init__(self, path):
+    def __init__(self, path, stat=None, document=None, storage=None):
         self.path = path
-        self.document = frontmatter.load(path)
+        self.stat = stat
+        self.storage = storage
+        self.library = None
+        if document is None:
+            with profiling.span("Book.parse"):
+                document = codec.load(path)
+        self.document = document
+        self.base = snapshot(document)
+        self.start_time = utilities.timestamp(self.date)
+        self.end_time = utilities.timestamp(self.end_date)
 
     @property
     def title(self):
@@ -67,13 +157,13 @@ class Book(object):
 
     @property
     def cover_path(self):
-        if "cover" in self.document.metadata:
+        if "thumbnail" in self.document.metadata:
             return os.path.join(os.path.dirname(self.path), self.document.metadata["thumbnail"])
         return None
 
     @property
     def raw_status(self):
-        return self.document.metadata["status"]
+        return self.document.metadata.get("status")
 
     @property
     def status(self):
@@ -98,6 +188,7 @@ class Book(object):
 
     @date.setter
     def date(self, date):
+        self.start_time = utilities.timestamp(date)
         if date is None:
             try:
                 del self.document.metadata["date"]
@@ -114,6 +205,7 @@ class Book(object):
 
     @end_date.setter
     def end_date(self, end_date):
+        self.end_time = utilities.timestamp(end_date)
         if end_date is None:
             try:
                 del self.document.metadata["end_date"]
@@ -122,37 +214,149 @@ class Book(object):
             return
         self.document.metadata["end_date"] = end_date.isoformat()
 
+    @profiling.traced("Book.save")
     def save(self):
-        with open(self.path, "w") as fh:
-            fh.write(frontmatter.dumps(self.document))
-            fh.write("\n")
-
+        if self.storage is not None:
+            self.storage.save(self)
+            return
+        codec.write(self.path, self.document)
+
+
+def insort(items, item, key):
+    value = key(item)
+    low, high = 0, len(items)
+    while low < high:
+        middle = (low + high) // 2
+        if value < key(items[middle]):
+            high = middle
+        else:
+            low = middle + 1
+    items.insert(low, item)
+
+
+class Library(object):
+
+    def __init__(self, books, sort=Sort.TITLE):
+        self.sort = sort
+        self.books = sorted(books, key=sort.value[1])
+        self.shelves = {status: [] for status in Status}
+        for book in self.books:
+            self.shelves[book.status].append(book)
+
+    def shelf(self, status=None):
+        if status is None:
+            return self.books
+        return self.shelves[status]
+
+    def set_status(self, book, status):
+        # Changing status can change the dates the sort is keyed on, so the book is put back in place in every list
+        # it's in, not just moved between shelves.
+        self.books.remove(book)
+        self.shelves[book.status].remove(book)
+        book.status = status
+        insort(self.books, book, key=self.sort.value[1])
+        insort(self.shelves[book.status], book, key=self.sort.value[1])
+
+    def sort_by(self, sort):
+        self.sort = sort
+        self.books.sort(key=sort.value[1])
+        for shelf in self.shelves.values():
+            shelf.sort(key=sort.value[1])
+
+
+SEARCH_BATCH_SIZE = 40
+SEARCH_PAGE_SIZE = 10
+
+
+class SearchResults(object):
+    # Everything fetched so far for one query. Pages are served from here, and the sources are only asked for another
+    # batch once the user pages past the end of what's already loaded. Sources are searched in turn, each from its own
+    # offset, moving on to the next once one runs out.
+
+    def __init__(self, sources, query, batch_size=SEARCH_BATCH_SIZE):
+        self.sources = list(sources)
+        self.query = query
+        self.batch_size = batch_size
+        self.books = []
+        self.ids = set()
+        self.offset = 0
 
-def interactive_search(search_callback):
+    @property
+    def exhausted(self):
+        return not self.sources
+
+    def fetch(self):
+        try:
+            books = self.sources[0](query=self.query, index=self.offset, count=self.batch_size)
+        except utilities.BookNotFound:
+            books = []
+        if not books:
+            self.sources.pop(0)
+            self.offset = 0
+            return
+        self.offset += len(books)
+        # Consecutive batches can overlap when the underlying results shift, and the network will return volumes the
+        # catalog already has, so skip anything we've already got.
+        for book in books:
+            if book.id not in self.ids:
+                self.ids.add(book.id)
+                self.books.append(book)
+
+    def page(self, number, size=SEARCH_PAGE_SIZE):
+        end = (number + 1) * size
+        while len(self.books) < end and not self.exhausted:
+            self.fetch()
+        return self.books[number * size:end]
+
+
+def start_search(prompt, sources, isbn_lookup=None):
+    # Asks for a query until there's something to show. ISBNs skip the picker altogether when they identify a single
+    # volume; returns `(volume, None)` then, `(None, results)` otherwise, and `(None, None)` if the user gives up.
+    while True:
+        query = input(prompt)
+        if not query:
+            return None, None
+        if isbn_lookup is not None:
+            try:
+                volumes = isbn_lookup(query)
+            except (isbns.InvalidISBN, isbns.InLibrary) as e:
+                prompt = f"{e} Search: "
+                continue
+            if volumes is not None:
+                if len(volumes) == 1:
+                    return volumes[0], None
+                elif not volumes:
+                    prompt = "No book with that ISBN. Search: "
+                    continue
+                return None, SearchResults([lambda query, index, count: volumes if index == 0 else []], query)
+        return None, SearchResults(sources, query)
+
+
+def interactive_search(sources, isbn_lookup=None):
     with tempfile.TemporaryDirectory() as temporary_directory:
         page = 0
         default_index = 0
         selected = None
 
-        query = input("Search: ")
-        if not query:
-            return
+        selected, results = start_search("Search: ", sources, isbn_lookup)
+        if results is None:
+            return selected
         while True:
-            books = search_callback(query=query, index=page)
+            books = results.page(page)
+            if not books:
+                selected, results = start_search("No results. Search: ", sources, isbn_lookup)
+                if results is None:
+                    return selected
+                page = 0
+                default_index = 0
+                continue
 
             def summary(book):
-                isbn = ""
-                try:
-                    isbn = book.isbn
-                except KeyError:
-                    pass
-                try:
-                    isbn = book.isbn_13
-                except KeyError:
-                    pass
+                isbn = book.isbn_13 or book.isbn or ""
                 return f"{book.title[:30]:34}{', '.join(book.authors)[:20]:24}{book.language[:3]:5}{isbn}"
 
             def show_webpage(picker):
+                import webbrowser
                 selection, index = picker.get_selected()
                 webbrowser.open(selection.url)
 
@@ -160,6 +364,8 @@ def interactive_search(search_callback):
                 return None, -1
 
             def next(picker):
+                if not results.page(page + 1):
+                    return
                 return None, -2
 
             def previous(picker):
@@ -206,13 +412,19 @@ def interactive_search(search_callback):
                 page = page + 1
                 default_index = 0
             elif index == -3:
-                query = input("Search: ")
+                selected, results = start_search("Search: ", sources, isbn_lookup)
+                if results is None:
+                    return selected
                 page = 0
                 default_index = 0
             elif index == -4:
                 selected, default_index = selected
                 preview_cover(temporary_directory, selected)
-                print(json.dumps(selected._data, indent=4))
+                try:
+                    print(json.dumps(selected.data, indent=4))
+                except utilities.BookNotFound:
+                    # Offline, say; what the search returned will have to do.
+                    print(json.dumps(selected.record, indent=4))
                 print(selected.metadata)
                 input("Press any key to continue...")
             elif index == -5:
@@ -259,42 +471,146 @@ class ManualBook(object):
 def preview_cover(temporary_directory, book):
     thumbnail = book.thumbnail
     if thumbnail is not None:
-        thumbnail_path = os.path.join(temporary_directory, "thumbnail.jpg")
-        utilities.download_image(thumbnail, thumbnail_path)
-        utilities.preview_image(thumbnail_path)
+        # Named after the URL, so looking at the same cover again doesn't download it again.
+        thumbnail_path = os.path.join(temporary_directory, hashlib.sha1(thumbnail.encode("utf-8")).hexdigest() + ".jpg")
+        if os.path.exists(thumbnail_path) or utilities.download_image(thumbnail, thumbnail_path):
+            utilities.preview_image(thumbnail_path)
+        else:
+            input("Unable to download cover.")
     else:
         input("Missing cover.")
 
 
-def load(path):
-    paths = [os.path.join(path, f) for f in os.listdir(path)
-             if (f.lower().endswith(".md") and
-                 not f.lower().endswith("index.md"))]
-    books = [Book(path) for path in paths]
+def is_book_file(name):
+    name = name.lower()
+    return name.endswith(".md") and not name.endswith("index.md")
+
+
+def scan(path, predicate=is_book_file):
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                yield from scan(entry.path, predicate)
+            elif predicate(entry.name):
+                yield entry
+
+
+def validate(book):
+    title = book.document.metadata.get("title")
+    if not isinstance(title, str) or not title:
+        raise InvalidBook(f"'{book.path}' has no title.")
+    book.status
+
+
+@profiling.traced("books.load")
+def load(path, quarantine=None):
+    # Books that can't be loaded are set aside in `quarantine`, as `(path, reason)`, when it's given; otherwise the
+    # first one stops the load. Each book keeps the stat the scan already made, which saves compare against to spot
+    # edits made behind our back.
+    books = []
+    for entry in scan(path):
+        try:
+            book = Book(entry.path, stat=entry.stat())
+            validate(book)
+        except LOAD_ERRORS as e:
+            if quarantine is None:
+                raise
+            quarantine.append((entry.path, str(e) or e.__class__.__name__))
+            continue
+        books.append(book)
     books = sorted(books, key=lambda x: x.title)
     return books
 
 
-def import_book(directory, new_book):
+def reshard(directory, layout, dry_run=False):
+    shard = LAYOUTS[layout]
+    moves = []
+    for book in load(directory):
+        basename = os.path.splitext(os.path.basename(book.path))[0]
+        source_directory = os.path.dirname(book.path)
+        destination_directory = os.path.join(directory, shard(basename, book.document.metadata))
+        if os.path.normpath(source_directory) == os.path.normpath(destination_directory):
+            continue
+        destination = os.path.join(destination_directory, os.path.basename(book.path))
+        moves.append((book.path, destination))
+        if dry_run:
+            continue
+        os.makedirs(destination_directory, exist_ok=True)
+
+        # Covers that live alongside the book move with it; any others stay put and the book points at them afresh.
+        thumbnail = book.document.metadata.get("thumbnail")
+        if thumbnail is not None:
+            cover_path = os.path.normpath(os.path.join(source_directory, thumbnail))
+            if os.path.dirname(cover_path) == os.path.normpath(source_directory) and os.path.exists(cover_path):
+                os.rename(cover_path, os.path.join(destination_directory, os.path.basename(cover_path)))
+                moves.append((cover_path, os.path.join(destination_directory, os.path.basename(cover_path))))
+            else:
+                book.document.metadata["thumbnail"] = os.path.relpath(cover_path, destination_directory)
+                book.save()
+        os.rename(book.path, destination)
+
+    if not dry_run:
+        for root, directories, files in os.walk(directory, topdown=False):
+            if root != directory and not os.path.basename(root).startswith(".") and not os.listdir(root):
+                os.rmdir(root)
+    return moves
+
+
+def identifiers(book):
+    metadata = book.document.metadata
+    yield os.path.splitext(os.path.basename(book.path))[0]
+    yield book.path
+    for key, value in metadata.get("ids", {}).items():
+        yield str(value)
+    for key in ("isbn", "isbn_13"):
+        if key in metadata:
+            yield str(metadata[key])
+
+
+def in_date_range(book, start=None, end=None):
+    # Books count as being in the range if they were being read at any point during it; books that are still being
+    # read extend to the present.
+    begin = book.start_time if book.start_time is not None else book.end_time
+    if begin is None:
+        return False
+    finish = book.end_time if book.end_time is not None else math.inf
+    return (end is None or begin <= end) and (start is None or finish >= start)
+
+
+@profiling.traced("books.prepare_book")
+def prepare_book(directory, new_book, layout="flat"):
     metadata = dict(new_book.metadata)
-    metadata["status"] = "to-read"
+    metadata.setdefault("status", "to-read")
+
+    library_directory = directory
+    directory = os.path.join(directory, LAYOUTS[layout](new_book.basename, metadata))
+    os.makedirs(directory, exist_ok=True)
 
     thumbnail = new_book.thumbnail
     if thumbnail is not None:
-        cover_basename = f"{new_book.basename}-cover.jpg"
-        utilities.download_image(thumbnail, os.path.join(directory, cover_basename))
-        metadata["thumbnail"] = cover_basename
+        cover_path = os.path.join(directory, f"{new_book.basename}-cover.jpg")
+        if utilities.download_image(thumbnail, cover_path):
+            # Libraries that have been through `dedupe-covers` keep every cover in the shared, content-addressed store.
+            if covers.has_store(library_directory):
+                cover_path = covers.add(library_directory, cover_path)
+            metadata["thumbnail"] = os.path.relpath(cover_path, directory)
 
-    contents = frontmatter.dumps(utilities.Document(content="", metadata=metadata))
     path = os.path.join(directory, f"{new_book.basename}.md")
-    with open(path, "w") as fh:
-        fh.write(contents)
-        fh.write("\n")
+    return path, utilities.Document(content="", metadata=metadata)
+
+
+@profiling.traced("books.import_book")
+def import_book(directory, new_book, layout="flat", storage=None):
+    path, document = prepare_book(directory, new_book, layout=layout)
+    write = storage.write if storage is not None else codec.write
+    write(path, document)
     return path
 
 
-def add_book(directory, search_callback):
-    new_book = interactive_search(search_callback=search_callback)
+def add_book(directory, sources, layout="flat", storage=None, isbn_lookup=None):
+    new_book = interactive_search(sources=sources, isbn_lookup=isbn_lookup)
     if new_book is None:
         return
-    return import_book(directory, new_book)
+    return import_book(directory, new_book, layout=layout, storage=storage)
@@ -1,21 +1,24 @@
 #!/usr/bin/env python3
 
 import argparse
+import atexit
+import concurrent.futures
 import curses
 import datetime
 import os
 import signal
 import subprocess
 import sys
-import time
 
-import dateutil.tz
-import frontmatter
 import pick
 import yaml
 
 import books
-import googlebooks
+import covers
+import isbns
+import locking
+import profiling
+import storage
 import utilities
 
 
@@ -46,24 +49,99 @@ def signal_handler(sig, frame):
     sys.exit(0)
 
 
-def interactive_books(directory, selected_path=None):
+class View(object):
+
+    def __init__(self):
+        self.sort = books.Sort.TITLE
+        self.shelf = None
+        self.start = None
+        self.end = None
+
+    @property
+    def is_filtered(self):
+        return self.start is not None or self.end is not None
+
+    @property
+    def description(self):
+        description = "All" if self.shelf is None else self.shelf.value[1]
+        description += f", by {self.sort.value[0].lower()}"
+        if self.is_filtered:
+            start = self.start.isoformat() if self.start is not None else "..."
+            end = self.end.isoformat() if self.end is not None else "..."
+            description += f", {start} to {end}"
+        return description
+
+    def apply(self, library):
+        if self.is_filtered:
+            start = utilities.timestamp(self.start)
+            end = utilities.timestamp(self.end + datetime.timedelta(days=1)) - 1 if self.end is not None else None
+            library = [book for book in library if books.in_date_range(book, start, end)]
+        return books.Library(library, sort=self.sort)
+
+
+def input_date(prompt):
+    while True:
+        value = input(prompt)
+        if not value:
+            return None
+        try:
+            return datetime.date.fromisoformat(value)
+        except ValueError:
+            print(f"'{value}' isn't a date (YYYY-MM-DD).")
+
+
+def interactive_books(storage, view, selected_path=None):
     statuses = list(books.Status)
+    shelves = [None] + statuses
 
-    def next_shelf(picker):
+    def summary(book):
+        # Books are only tagged with their library when there's more than one.
+        library = getattr(book, "library", None)
+        return f"{book.summary} ({library})" if library is not None else book.summary
+
+    def show(picker, selected=None):
+        options = library.shelf(view.shelf)
+        picker.options = options if options else [EmptyBook()]
+        picker.index = options.index(selected) if selected in options else 0
+        picker.title = title()
+
+    def change_status(picker, offset):
         selected, index = picker.get_selected()
-        new_status_index = (statuses.index(selected.status) + 1)
-        if new_status_index >= len(statuses):
+        if isinstance(selected, EmptyBook):
             return
-        selected.status = statuses[new_status_index]
-        selected.save()
+        new_status_index = (statuses.index(selected.status) + offset)
+        if new_status_index < 0 or new_status_index >= len(statuses):
+            return
+        library.set_status(selected, statuses[new_status_index])
+        try:
+            selected.save()
+        except books.ConflictError as e:
+            return e, -9
+        if view.shelf is not None:
+            # The book has moved to another shelf, taking it out of the one on screen.
+            picker.index = min(index, len(picker.options) - 1)
+            if not picker.options:
+                show(picker)
+        else:
+            # Under a date sort the book may have moved, so follow it.
+            picker.index = picker.options.index(selected)
+
+    def next_shelf(picker):
+        return change_status(picker, 1)
 
     def previous_shelf(picker):
+        return change_status(picker, -1)
+
+    def change_view(picker, offset):
         selected, index = picker.get_selected()
-        new_status_index = (statuses.index(selected.status) - 1)
-        if new_status_index < 0:
-            return
-        selected.status = statuses[new_status_index]
-        selected.save()
+        view.shelf = shelves[(shelves.index(view.shelf) + offset) % len(shelves)]
+        show(picker, selected)
+
+    def next_view(picker):
+        change_view(picker, 1)
+
+    def previous_view(picker):
+        change_view(picker, -1)
 
     def add_book(picker):
         return None, -2
@@ -73,6 +151,8 @@ def interactive_books(directory, selected_path=None):
 
     def delete_book(picker):
         selected, index = picker.get_selected()
+        if isinstance(selected, EmptyBook):
+            return
         return selected, -5
 
     def cancel(picker):
@@ -80,24 +160,47 @@ def interactive_books(directory, selected_path=None):
 
     def thumbnail(picker):
         selected, index = picker.get_selected()
+        if isinstance(selected, EmptyBook):
+            return
         return selected, -4
 
     def edit(picker):
         selected, index = picker.get_selected()
+        if isinstance(selected, EmptyBook):
+            return
         return selected, -6
 
+    def change_sort(picker):
+        selected, index = picker.get_selected()
+        sorts = list(books.Sort)
+        view.sort = sorts[(sorts.index(view.sort) + 1) % len(sorts)]
+        library.sort_by(view.sort)
+        show(picker, selected)
+
+    def filter_dates(picker):
+        return None, -8
+
+    def title():
+        warning = f"{len(quarantined)} book(s) couldn't be loaded; run 'bookshelf check'.\n\n" if quarantined else ""
+        return f"Bookshelf ({view.description})\n\n{warning}tab - add book\n` - add book manually\nleft/right - change status\n[/] - change shelf\n\\ - view thumbnail\n+ - edit\n= - change sort order\n@ - filter by date\ndel - delete\nesc - exit"
+
     signal.signal(signal.SIGINT, signal_handler)
     utilities.set_escdelay(25)
-    options = books.load(directory)
+    library = view.apply(storage.load())
+    quarantined = storage.quarantined
+    options = library.shelf(view.shelf)
     if not options:
         options = [EmptyBook()]
-    default_index = [book.path for book in options].index(selected_path) if selected_path is not None else 0
+    paths = [book.path for book in options if not isinstance(book, EmptyBook)]
+    default_index = paths.index(selected_path) if selected_path in paths else 0
     picker = utilities.SearchablePicker(options=options,
-                                        title="Bookshelf\n\ntab - add book\n` - add book manually\nleft/right - change status\n\\ - view thumbnail\n+ - edit\ndel - delete\nesc - exit",
-                                        options_map_func=lambda x: x.summary,
+                                        title=title(),
+                                        options_map_func=summary,
                                         default_index=default_index)
     picker.register_custom_handler(curses.KEY_LEFT, previous_shelf)
     picker.register_custom_handler(curses.KEY_RIGHT, next_shelf)
+    picker.register_custom_handler(ord('['), previous_view)
+    picker.register_custom_handler(ord(']'), next_view)
     picker.register_custom_handler(ord('\t'), add_book)
     picker.register_custom_handler(ord('`'), add_book_manual)
     picker.register_custom_handler(ord('\\'), thumbnail)
@@ -105,6 +208,8 @@ def interactive_books(directory, selected_path=None):
     picker.register_custom_handler(curses.KEY_BACKSPACE, delete_book)
     picker.register_custom_handler(27, cancel)
     picker.register_custom_handler(ord('+'), edit)
+    picker.register_custom_handler(ord('='), change_sort)
+    picker.register_custom_handler(ord('@'), filter_dates)
 
     book, index = picker.start()
     if index == -2:
@@ -120,64 +225,404 @@ def interactive_books(directory, selected_path=None):
     elif index == -5:
         answer = input("Delete book? [y/N] ")
         if answer.lower() == "y":
-            if book.cover_path is not None and os.path.exists(book.cover_path):
+            # Covers in the store may be shared with other books; `dedupe-covers --prune` tidies them up.
+            if book.cover_path is not None and os.path.exists(book.cover_path) and \
+                    not covers.is_stored(book.storage.directory, book.cover_path):
                 os.remove(book.cover_path)
-            if os.path.exists(book.path):
-                os.remove(book.path)
+            storage.delete(book)
             return
     elif index == -6:
-        subprocess.check_call([os.environ['EDITOR'], book.path])
+        try:
+            storage.edit(book)
+        except books.ConflictError as e:
+            input(f"{e} Press enter to reload.")
     elif index == -7:
         raise AddBookManualInterrupt()
+    elif index == -8:
+        view.start = input_date("From (YYYY-MM-DD, blank for no limit): ")
+        view.end = input_date("To (YYYY-MM-DD, blank for no limit): ")
+        return selected_path
+    elif index == -9:
+        input(f"{book} Press enter to reload.")
+        return selected_path
+    elif isinstance(book, EmptyBook):
+        return selected_path
     return book.path
 
 
+def git(*arguments, directory=None):
+    with profiling.span(f"git {arguments[0]}", arguments=list(arguments), directory=directory):
+        subprocess.check_call(["git"] + list(arguments), cwd=directory)
+
+
+def update_library(library):
+    with locking.library_lock(library["library_path"]).exclusive():
+        git("fetch", "origin", directory=library["library_path"])
+        git("rebase", "--autostash", "origin/main", directory=library["library_path"])
+
+
+def save_library(library):
+    with locking.library_lock(library["library_path"]).exclusive():
+        git("add", ".", directory=library["library_path"])
+        changes = subprocess.check_output(["git", "status", "--porcelain"], cwd=library["library_path"])
+        if changes:
+            git("commit", "-m", "Updating reading list", directory=library["library_path"])
+        git("push", directory=library["library_path"])
+
+
+def sync_libraries(function, libraries):
+    # Every library is its own repository, so they're synced side by side; one failing doesn't stop the others.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(libraries)) as executor:
+        futures = [(library, executor.submit(function, library)) for library in libraries]
+    failures = []
+    for library, future in futures:
+        try:
+            future.result()
+        except (subprocess.CalledProcessError, OSError) as e:
+            failures.append(f"'{library['name']}' ({library['library_path']}): {e}")
+    if failures:
+        exit("Unable to sync " + "; ".join(failures))
+
+
+def write_profile(tracer, path):
+    tracer.write(path)
+    print(tracer.summary())
+    print(f"\nTrace written to '{path}'.")
+
+
 class Bookshelf(object):
 
-    def __init__(self, path):
-        self.directory = path
+    def __init__(self, libraries, storage):
+        self.libraries = libraries
+        self.storage = storage
+        self.view = View()
+
+    def library_storage(self, library):
+        if isinstance(self.storage, storage.MultiStorage):
+            return dict(self.storage.libraries)[library["name"]]
+        return self.storage
+
+    def choose_library(self):
+        # New books need a home; only ask when there's a choice.
+        if len(self.libraries) == 1:
+            return self.libraries[0]
+        picker = pick.Picker([library["name"] for library in self.libraries], "Add to library\n\nesc - cancel",
+                             indicator="*")
+        picker.register_custom_handler(27, lambda picker: (None, -1))
+        name, index = picker.start()
+        return self.libraries[index] if index >= 0 else None
 
     def run(self, offline):
 
         if not offline:
             print("Updating library...")
-            with utilities.Chdir(self.directory):
-                subprocess.check_call(["git", "fetch", "origin"])
-                subprocess.check_call(["git", "rebase", "--autostash", "origin/main"])
+            sync_libraries(update_library, self.libraries)
 
         new_book_path = None
         while True:
             try:
-                new_book_path = interactive_books(directory=self.directory, selected_path=new_book_path)
+                new_book_path = interactive_books(storage=self.storage, view=self.view, selected_path=new_book_path)
             except AddBookInterrupt:
-                new_book_path = books.add_book(directory=self.directory, search_callback=googlebooks.search)
+                library = self.choose_library()
+                if library is None:
+                    continue
+                # The network stack is only needed once we search, so keep it out of startup.
+                import catalog
+                library_catalog = catalog.Catalog(offline=offline)
+                new_book_path = books.add_book(directory=library["library_path"],
+                                               sources=library_catalog.sources(),
+                                               layout=library["layout"],
+                                               storage=self.library_storage(library),
+                                               isbn_lookup=isbns.Lookup(load_library=self.storage.load,
+                                                                        catalog=library_catalog))
             except AddBookManualInterrupt:
+                library = self.choose_library()
+                if library is None:
+                    continue
                 new_book = books.add_book_manual()
-                new_book_path = books.import_book(self.directory, new_book)
+                new_book_path = books.import_book(library["library_path"], new_book, layout=library["layout"],
+                                                  storage=self.library_storage(library))
             except ExitInterrupt:
                 if not offline:
                     answer = input("Save? [Y/n] ")
                     if answer.lower() == "y" or answer == "":
                         print("Saving...")
-                        with utilities.Chdir(self.directory):
-                            subprocess.check_call(["git", "add", "."])
-                            subprocess.check_call(["git", "commit", "-m", "Updating reading list"])
-                            subprocess.check_call(["git", "push"])
+                        sync_libraries(save_library, self.libraries)
                 exit(0)
 
 
+def command_stats(config, options):
+    import stats
+    stats.print_summary(stats.summarize(storage.open_library(config).load()), format=options.format)
+
+
+def command_export(config, options):
+    import export
+    exporter = export.Exporter(output=options.output, templates_directory=options.templates, jobs=options.jobs)
+    changed = exporter.export(storage.open_library(config).load(), force=options.force)
+    print(f"Rendered {len(changed)} book(s).")
+
+
+def command_add(config, options):
+    import batch
+    importer = batch.Importer(storage=storage.open_library(config),
+                              directory=config["library_path"],
+                              layout=config["layout"],
+                              jobs=options.jobs)
+    counts = batch.print_results(importer.run((isbn, options.status) for isbn in batch.read_lines(options.isbn)))
+    if counts["failed"]:
+        exit(1)
+
+
+def command_import_csv(config, options):
+    import batch
+    importer = batch.Importer(storage=storage.open_library(config),
+                              directory=config["library_path"],
+                              layout=config["layout"],
+                              jobs=options.jobs)
+    with (open(options.path, newline="") if options.path != "-" else sys.stdin) as fh:
+        counts = batch.print_results(importer.run(batch.csv_requests(fh)))
+    if counts["failed"]:
+        exit(1)
+
+
+def command_import_goodreads(config, options):
+    import batch
+    import goodreads
+    importer = goodreads.Importer(storage=storage.open_library(config),
+                                  directory=config["library_path"],
+                                  layout=config["layout"],
+                                  jobs=options.jobs)
+    with (open(options.path, newline="") if options.path != "-" else sys.stdin) as fh:
+        counts = batch.print_results(importer.run(goodreads.rows(fh)))
+    if counts["failed"]:
+        exit(1)
+
+
+def command_set_status(config, options):
+    import batch
+    counts = batch.print_results(batch.set_status(storage.open_library(config),
+                                                  batch.read_lines(options.id),
+                                                  books.STATUS_NAMES[options.status]))
+    if counts["missing"] or counts["failed"]:
+        exit(1)
+
+
+def command_list(config, options):
+    library = books.Library(storage.open_library(config).load())
+    status_names = {status: name for name, status in books.STATUS_NAMES.items()}
+    for book in library.shelf(books.STATUS_NAMES[options.status] if options.status is not None else None):
+        basename = os.path.splitext(os.path.basename(book.path))[0]
+        print(f"{basename}\t{status_names[book.status]}\t{book.title}")
+
+
+def command_reshard(config, options):
+    if config["storage"] != "markdown":
+        exit("Only Markdown libraries can be resharded.")
+    with locking.library_lock(config["library_path"]).exclusive():
+        moves = books.reshard(config["library_path"], options.layout, dry_run=options.dry_run)
+    for source, destination in moves:
+        print(f"{os.path.relpath(source, config['library_path'])} -> "
+              f"{os.path.relpath(destination, config['library_path'])}")
+    if not options.dry_run and options.layout != config["layout"]:
+        print(f"\nSet 'layout: {options.layout}' in '{CONFIG_PATH}' to add new books to the same layout.")
+
+
+def command_sqlite(config, options):
+    database = storage.SQLiteStorage(config["library_path"])
+    if options.action == "import":
+        count = database.import_markdown(options.directory)
+        print(f"Imported {count} book(s) into '{database.path}'.")
+    else:
+        count = database.export_markdown(options.directory)
+        print(f"Exported {count} book(s) from '{database.path}'.")
+
+
+def command_dedupe_covers(config, options):
+    library_storage = storage.open_library(config)
+    library = library_storage.load()
+    summary = covers.deduplicate(library, config["library_path"], library_storage, jobs=options.jobs,
+                                 hard_link=options.link, dry_run=options.dry_run)
+    pruned = covers.prune(library, config["library_path"], dry_run=options.dry_run) if options.prune else []
+    print(f"Hashed {summary.covers} cover(s): {summary.duplicates} duplicate(s), {summary.bytes / 1024 / 1024:.1f} MB.")
+    if not options.link:
+        print(f"Pointed {summary.books} book(s) at '{covers.store_path(config['library_path'])}'.")
+    if options.prune:
+        print(f"Removed {len(pruned)} unused cover(s) from the store.")
+
+
+def command_check(config, options):
+    if config["storage"] != "markdown":
+        exit("Only Markdown libraries can be checked.")
+    import check
+    report = check.check(config["library_path"], jobs=options.jobs)
+    check.print_report(report, format=options.format)
+    if report["errors"]:
+        exit(1)
+
+
+def command_daemon(config, options):
+    import daemon
+    config["daemon_socket"] = None
+    daemon.serve(storage.open_library(config), path=options.socket, interval=options.interval)
+
+
+def library_configs(config):
+    # `libraries` lists several libraries to browse together; otherwise `library_path` is the only one. Each library
+    # gets a complete configuration of its own, taking anything it doesn't set from the top level.
+    if "libraries" in config:
+        entries = config["libraries"]
+    else:
+        entries = [{"path": config["library_path"]}]
+    libraries = []
+    for index, entry in enumerate(entries):
+        library = {key: value for key, value in config.items() if key != "libraries"}
+        library.update({key: value for key, value in entry.items() if key != "path"})
+        library["library_path"] = os.path.expanduser(entry["path"])
+        library.setdefault("name", os.path.basename(os.path.normpath(library["library_path"])))
+        if index > 0 and "daemon_socket" not in entry:
+            # A daemon serves a single library, and the default socket belongs to the first.
+            library["daemon_socket"] = None
+        libraries.append(library)
+    # Names pick a library (`--library`), tag its books and route their changes back to it, so they have to be unique.
+    names = [library["name"] for library in libraries]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        exit(f"More than one library is named {', '.join(repr(name) for name in duplicates)}; give each library "
+             f"in 'libraries' a unique 'name'.")
+    return libraries
+
+
+def select_library(libraries, name=None):
+    if name is None:
+        return libraries[0]
+    for library in libraries:
+        if library["name"] == name:
+            return library
+    exit(f"No library named '{name}'; choose from {', '.join(library['name'] for library in libraries)}.")
+
+
 def main():
     parser = argparse.ArgumentParser(description="Book tracker.")
     parser.add_argument("--offline", "-o", action="store_true", default=False, help="work offline")
+    parser.add_argument("--profile", action="store_true", default=False,
+                        help="time slow operations and report them on exit")
+    parser.add_argument("--no-daemon", action="store_true", default=False,
+                        help="read the library from disk even if a daemon is running")
+    parser.add_argument("--library", "-l", default=None, metavar="NAME",
+                        help="library for commands to work on, when there are several (default: the first)")
+    parser.add_argument("--trace", default="bookshelf-trace.json", metavar="PATH",
+                        help="where to write the Chrome trace when profiling (default: bookshelf-trace.json)")
+    parser.add_argument("--metrics", default=None, metavar="PATH",
+                        help="record counters and timings and add them to a Prometheus textfile (.prom) or JSON lines "
+                             "file on exit (default: 'metrics_path' in the configuration, if set)")
+    subparsers = parser.add_subparsers(dest="command")
+
+    stats_parser = subparsers.add_parser("stats", help="show reading statistics")
+    stats_parser.add_argument("--format", choices=["table", "json"], default="table", help="output format")
+    stats_parser.set_defaults(handler=command_stats)
+
+    export_parser = subparsers.add_parser("export", help="render the library to HTML, JSON and CSV")
+    export_parser.add_argument("output", help="output directory")
+    export_parser.add_argument("--templates", default=None, help="Jinja2 templates directory")
+    export_parser.add_argument("--jobs", "-j", type=int, default=None, help="number of parallel render jobs")
+    export_parser.add_argument("--force", "-f", action="store_true", default=False, help="re-render every page")
+    export_parser.set_defaults(handler=command_export)
+
+    statuses = list(books.STATUS_NAMES.keys())
+
+    add_parser = subparsers.add_parser("add", help="add books by ISBN without the picker")
+    add_parser.add_argument("--isbn", nargs="*", default=[], help="ISBNs to add (default: read from stdin)")
+    add_parser.add_argument("--status", choices=statuses, default=None, help="shelf for the new books")
+    add_parser.add_argument("--jobs", "-j", type=int, default=8, help="number of concurrent lookups")
+    add_parser.set_defaults(handler=command_add)
+
+    import_csv_parser = subparsers.add_parser("import-csv", help="add books from a CSV file with 'isbn' and "
+                                                                 "(optionally) 'status' columns")
+    import_csv_parser.add_argument("path", nargs="?", default="-", help="CSV file (default: stdin)")
+    import_csv_parser.add_argument("--jobs", "-j", type=int, default=8, help="number of concurrent lookups")
+    import_csv_parser.set_defaults(handler=command_import_csv)
+
+    import_goodreads_parser = subparsers.add_parser("import-goodreads", help="add books from a Goodreads library "
+                                                                         "export")
+    import_goodreads_parser.add_argument("path", nargs="?", default="-", help="Goodreads CSV export (default: stdin)")
+    import_goodreads_parser.add_argument("--jobs", "-j", type=int, default=8, help="number of concurrent lookups")
+    import_goodreads_parser.set_defaults(handler=command_import_goodreads)
+
+    set_status_parser = subparsers.add_parser("set-status", help="move books to a shelf")
+    set_status_parser.add_argument("status", choices=statuses, help="new shelf")
+    set_status_parser.add_argument("id", nargs="*", default=[],
+                                   help="file names, ISBNs or Google Books IDs (default: read from stdin)")
+    set_status_parser.set_defaults(handler=command_set_status)
+
+    list_parser = subparsers.add_parser("list", help="list books")
+    list_parser.add_argument("--status", choices=statuses, default=None, help="only list books on this shelf")
+    list_parser.set_defaults(handler=command_list)
+
+    reshard_parser = subparsers.add_parser("reshard", help="move books into a different directory layout")
+    reshard_parser.add_argument("layout", choices=list(books.LAYOUTS.keys()), help="directory layout")
+    reshard_parser.add_argument("--dry-run", "-n", action="store_true", default=False,
+                                help="list the moves without making them")
+    reshard_parser.set_defaults(handler=command_reshard)
+
+    sqlite_parser = subparsers.add_parser("sqlite", help="copy books between Markdown files and the SQLite database")
+    sqlite_parser.add_argument("action", choices=["import", "export"],
+                               help="import Markdown files into the database, or export the database to Markdown")
+    sqlite_parser.add_argument("directory", nargs="?", default=None,
+                               help="Markdown directory (default: the library)")
+    sqlite_parser.set_defaults(handler=command_sqlite)
+
+    check_parser = subparsers.add_parser("check", help="check every book's front matter, dates and covers")
+    check_parser.add_argument("--format", choices=["table", "json"], default="table", help="output format")
+    check_parser.add_argument("--jobs", "-j", type=int, default=None, help="number of worker processes")
+    check_parser.set_defaults(handler=command_check)
+
+    dedupe_covers_parser = subparsers.add_parser("dedupe-covers", help="keep one copy of each distinct cover")
+    dedupe_covers_parser.add_argument("--link", action="store_true", default=False,
+                                      help="replace duplicates with hard links instead of moving covers into the store")
+    dedupe_covers_parser.add_argument("--prune", action="store_true", default=False,
+                                      help="remove covers in the store that no book uses")
+    dedupe_covers_parser.add_argument("--jobs", "-j", type=int, default=8, help="number of files hashed at once")
+    dedupe_covers_parser.add_argument("--dry-run", "-n", action="store_true", default=False,
+                                      help="report what would change without changing anything")
+    dedupe_covers_parser.set_defaults(handler=command_dedupe_covers)
+
+    daemon_parser = subparsers.add_parser("daemon", help="keep the library loaded and serve it over a Unix socket")
+    daemon_parser.add_argument("--socket", default=storage.SOCKET_PATH,
+                               help=f"socket path (default: {storage.SOCKET_PATH})")
+    daemon_parser.add_argument("--interval", type=float, default=1.0,
+                               help="seconds between checks for changes to the library")
+    daemon_parser.set_defaults(handler=command_daemon)
+
     options = parser.parse_args()
 
+    if options.profile:
+        atexit.register(write_profile, profiling.enable(), os.path.abspath(options.trace))
+
     try:
         with open(CONFIG_PATH, "r") as fh:
             config = yaml.safe_load(fh)
     except FileNotFoundError:
         exit(f"Configuration file '{CONFIG_PATH}' not found.")
 
-    bookshelf = Bookshelf(path=os.path.expanduser(config["library_path"]))
+    metrics_path = options.metrics or config.get("metrics_path")
+    if metrics_path is not None:
+        import metrics
+        atexit.register(metrics.write, metrics.enable(), os.path.abspath(os.path.expanduser(metrics_path)),
+                        command=options.command or "browse")
+
+    config.setdefault("layout", "flat")
+    config.setdefault("storage", "markdown")
+    config.setdefault("daemon_socket", storage.SOCKET_PATH)
+    libraries = library_configs(config)
+    if options.no_daemon:
+        for library in libraries:
+            library["daemon_socket"] = None
+    if options.command is not None:
+        options.handler(select_library(libraries, options.library), options)
+        return
+
+    bookshelf = Bookshelf(libraries=libraries, storage=storage.open_libraries(libraries))
     bookshelf.run(offline=options.offline)
 
 
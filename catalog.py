@@ -0,0 +1,118 @@
+import json
+import os
+import sqlite3
+import time
+
+import metrics
+import utilities
+
+
+CATALOG_PATH = os.path.expanduser("~/.config/bookshelf/catalog.sqlite")
+PAGE_SIZE = 10
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS volumes (
+    source TEXT NOT NULL,
+    id TEXT NOT NULL,
+    title TEXT NOT NULL,
+    authors TEXT NOT NULL,
+    isbn_10 TEXT,
+    isbn_13 TEXT,
+    thumbnail TEXT,
+    data TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (source, id)
+);
+CREATE INDEX IF NOT EXISTS volumes_isbn_10 ON volumes (isbn_10);
+CREATE INDEX IF NOT EXISTS volumes_isbn_13 ON volumes (isbn_13);
+CREATE VIRTUAL TABLE IF NOT EXISTS volumes_search USING fts5(title, authors, content='volumes', content_rowid='rowid');
+CREATE TRIGGER IF NOT EXISTS volumes_insert AFTER INSERT ON volumes BEGIN
+    INSERT INTO volumes_search (rowid, title, authors) VALUES (new.rowid, new.title, new.authors);
+END;
+CREATE TRIGGER IF NOT EXISTS volumes_update AFTER UPDATE ON volumes BEGIN
+    INSERT INTO volumes_search (volumes_search, rowid, title, authors)
+    VALUES ('delete', old.rowid, old.title, old.authors);
+    INSERT INTO volumes_search (rowid, title, authors) VALUES (new.rowid, new.title, new.authors);
+END;
+"""
+
+UPSERT = """
+INSERT INTO volumes (source, id, title, authors, isbn_10, isbn_13, thumbnail, data, updated)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (source, id) DO UPDATE SET
+    title = excluded.title,
+    authors = excluded.authors,
+    isbn_10 = excluded.isbn_10,
+    isbn_13 = excluded.isbn_13,
+    thumbnail = excluded.thumbnail,
+    data = excluded.data,
+    updated = excluded.updated
+"""
+
+
+def match_expression(query):
+    # Every word must prefix-match a word in the title or authors; quoting keeps FTS5 operators out of user input.
+    terms = ['"' + term.replace('"', '""') + '"*' for term in query.split()]
+    return " ".join(terms)
+
+
+class Catalog(object):
+
+    def __init__(self, path=CATALOG_PATH, offline=False):
+        self.path = path
+        self.offline = offline
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+
+    def record(self, source, volumes):
+        # Each volume is an `(id, title, authors, isbn_10, isbn_13, thumbnail, data)` tuple. `data` is the record in the
+        # source's own shape, but only with the fields the search asked for, not the full volume; anything that needs
+        # the rest fetches it (see `GoogleBook.data`).
+        rows = [(source, identifier, title, ", ".join(authors), isbn_10, isbn_13, thumbnail, json.dumps(data),
+                 time.time())
+                for identifier, title, authors, isbn_10, isbn_13, thumbnail, data in volumes]
+        with self.connection:
+            self.connection.executemany(UPSERT, rows)
+
+    def add_google_books(self, volumes):
+        self.record("google_books", [(book.id, book.title, book.authors, book.isbn, book.isbn_13, book.thumbnail,
+                                      book.record)
+                                     for book in volumes])
+
+    def google_books(self, rows):
+        import googlebooks
+        return [googlebooks.GoogleBook(json.loads(data)) for data, in rows]
+
+    def find(self, query, index=0, limit=PAGE_SIZE):
+        expression = match_expression(query)
+        if not expression:
+            return []
+        return self.google_books(self.connection.execute(
+            "SELECT volumes.data FROM volumes_search JOIN volumes ON volumes.rowid = volumes_search.rowid "
+            "WHERE volumes_search MATCH ? AND volumes.source = 'google_books' ORDER BY rank LIMIT ? OFFSET ?",
+            (expression, limit, index)))
+
+    def find_isbn(self, isbn):
+        return self.google_books(self.connection.execute(
+            "SELECT data FROM volumes WHERE source = 'google_books' AND (isbn_13 = ? OR isbn_10 = ?)", (isbn, isbn)))
+
+    def search(self, query, index=0, count=PAGE_SIZE):
+        books = self.find(query, index=index, limit=count)
+        metrics.inc("bookshelf_catalog_searches_total", result="hit" if books else "miss")
+        if not books:
+            raise utilities.BookNotFound()
+        return books
+
+    def search_network(self, query, index=0, count=PAGE_SIZE):
+        import googlebooks
+        books = googlebooks.search(query=query, index=index, count=count)
+        self.add_google_books(books)
+        return books
+
+    def sources(self):
+        # Volumes seen before come straight from the catalog, and the network carries on once they run out. Each
+        # source is paged from its own offset.
+        if self.offline:
+            return [self.search]
+        return [self.search, self.search_network]
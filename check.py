@@ -0,0 +1,117 @@
+import collections
+import concurrent.futures
+import json
+import os
+
+import books
+import codec
+import utilities
+
+
+COVER_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".webp")
+CHUNK_SIZE = 200
+
+Issue = collections.namedtuple("Issue", ["path", "check", "severity", "message"])
+
+
+def is_cover_file(name):
+    return name.lower().endswith(COVER_EXTENSIONS)
+
+
+def check_dates(path, metadata):
+    issues = []
+    for key in ("date", "end_date"):
+        try:
+            utilities.timestamp(metadata.get(key))
+        except (ValueError, TypeError, OverflowError) as e:
+            issues.append(Issue(path, "invalid-date", "error", f"'{key}' isn't a date: {e}"))
+    return issues
+
+
+def check_book(path):
+    # Returns the problems with one book, and the cover it refers to.
+    try:
+        document = codec.load(path)
+    except Exception as e:
+        return [Issue(path, "invalid-front-matter", "error", " ".join(str(e).split()) or e.__class__.__name__)], None
+
+    metadata = document.metadata
+    issues = []
+    title = metadata.get("title")
+    if not isinstance(title, str) or not title:
+        issues.append(Issue(path, "missing-title", "error", "There's no title."))
+
+    status = metadata.get("status")
+    if status not in {status.value[0] for status in books.Status}:
+        issues.append(Issue(path, "invalid-status", "error", f"'{status}' isn't a status."))
+        status = None
+
+    date_issues = check_dates(path, metadata)
+    issues.extend(date_issues)
+    if not date_issues:
+        book = books.Book(path, document=document)
+        if book.start_time is not None and book.end_time is not None and book.end_time < book.start_time:
+            issues.append(Issue(path, "dates-reversed", "warning", "'end_date' is before 'date'."))
+        if status is not None:
+            try:
+                books.get_status(book)
+            except books.InvalidBook:
+                issues.append(Issue(path, "inconsistent-status", "error",
+                                    f"'{status}' doesn't match the dates ({book.date or 'no date'} to "
+                                    f"{book.end_date or 'no end date'})."))
+
+    cover_path = None
+    thumbnail = metadata.get("thumbnail")
+    if thumbnail is not None:
+        cover_path = os.path.realpath(os.path.join(os.path.dirname(path), str(thumbnail)))
+        if not os.path.isfile(cover_path):
+            issues.append(Issue(path, "missing-cover", "error", f"The cover '{thumbnail}' doesn't exist."))
+    return issues, cover_path
+
+
+def check_books(paths):
+    return [check_book(path) for path in paths]
+
+
+def chunks(items, size):
+    for index in range(0, len(items), size):
+        yield items[index:index + size]
+
+
+def check(directory, jobs=None):
+    paths = [entry.path for entry in books.scan(directory)]
+    issues = []
+    covers = set()
+    # Parsing YAML is CPU bound, so spread the books across processes, a chunk at a time to keep the overheads down.
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        for results in executor.map(check_books, chunks(paths, CHUNK_SIZE)):
+            for book_issues, cover_path in results:
+                issues.extend(book_issues)
+                if cover_path is not None:
+                    covers.add(cover_path)
+
+    cover_files = [entry.path for entry in books.scan(directory, predicate=is_cover_file)]
+    for path in cover_files:
+        if os.path.realpath(path) not in covers:
+            issues.append(Issue(path, "orphaned-cover", "warning", "No book uses this cover."))
+
+    return {
+        "library": directory,
+        "books": len(paths),
+        "covers": len(cover_files),
+        "errors": sum(1 for issue in issues if issue.severity == "error"),
+        "warnings": sum(1 for issue in issues if issue.severity == "warning"),
+        "checks": dict(collections.Counter(issue.check for issue in issues)),
+        "issues": [dict(issue._asdict(), path=os.path.relpath(issue.path, directory))
+                   for issue in sorted(issues)],
+    }
+
+
+def print_report(report, format="table"):
+    if format == "json":
+        print(json.dumps(report, indent=4))
+        return
+    for issue in report["issues"]:
+        print(f"{issue['severity']}\t{issue['check']}\t{issue['path']}\t{issue['message']}")
+    print(f"Checked {report['books']} book(s) and {report['covers']} cover(s): {report['errors']} error(s), "
+          f"{report['warnings']} warning(s).")
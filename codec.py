@@ -0,0 +1,24 @@
+import frontmatter
+
+
+# python-frontmatter already parses and dumps with libyaml (CSafeLoader and CSafeDumper) when it's installed, so the
+# stock handler is all that's needed. Passing it skips sniffing each file's delimiters; every book uses YAML.
+HANDLER = frontmatter.YAMLHandler()
+
+
+def load(path):
+    return frontmatter.load(path, handler=HANDLER)
+
+
+def loads(text):
+    return frontmatter.loads(text, handler=HANDLER)
+
+
+def dumps(document):
+    return frontmatter.dumps(document, handler=HANDLER)
+
+
+def write(path, document):
+    with open(path, "w") as fh:
+        fh.write(dumps(document))
+        fh.write("\n")
@@ -0,0 +1,139 @@
+import collections
+import hashlib
+import os
+import shutil
+
+import locking
+import utilities
+
+
+STORE_DIRECTORY = "covers"
+
+
+def store_path(directory):
+    return os.path.join(directory, STORE_DIRECTORY)
+
+
+def has_store(directory):
+    return os.path.isdir(store_path(directory))
+
+
+def is_stored(directory, path):
+    return os.path.dirname(os.path.realpath(path)) == os.path.realpath(store_path(directory))
+
+
+def cover_path(book):
+    thumbnail = book.document.metadata.get("thumbnail")
+    return os.path.join(os.path.dirname(book.path), thumbnail) if thumbnail is not None else None
+
+
+def digest(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(65536), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def stored_path(directory, path, sha256):
+    _, ext = os.path.splitext(path)
+    return os.path.join(store_path(directory), f"{sha256}{ext.lower() or '.jpg'}")
+
+
+def add(directory, path, sha256=None):
+    # Covers are named after their content, so a cover that's already in the store is simply dropped.
+    destination = stored_path(directory, path, sha256 or digest(path))
+    if os.path.exists(destination):
+        os.remove(path)
+    else:
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        os.replace(path, destination)
+    return destination
+
+
+def copy(directory, path, sha256):
+    # Like `add`, but leaves the original where it is.
+    destination = stored_path(directory, path, sha256)
+    if not os.path.exists(destination):
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        temporary_path = f"{destination}.{os.getpid()}.tmp"
+        shutil.copyfile(path, temporary_path)
+        os.replace(temporary_path, destination)
+    return destination
+
+
+def link(source, destination):
+    temporary_path = f"{destination}.link"
+    os.link(source, temporary_path)
+    os.replace(temporary_path, destination)
+
+
+Summary = collections.namedtuple("Summary", ["covers", "duplicates", "bytes", "books"])
+
+
+def deduplicate(library, directory, storage, jobs=8, hard_link=False, dry_run=False):
+    # Covers are compared by their real paths, so the library directory has to be too, or covers already in the store
+    # (reached through a symlink, say) look like copies of themselves.
+    directory = os.path.realpath(directory)
+    references = collections.defaultdict(list)
+    for book in library:
+        path = cover_path(book)
+        if path is not None and os.path.exists(path):
+            references[os.path.realpath(path)].append(book)
+    paths = sorted(references)
+
+    groups = collections.defaultdict(list)
+    for path, sha256 in zip(paths, utilities.bounded_map(digest, paths, workers=jobs)):
+        groups[sha256].append(path)
+
+    duplicates = 0
+    saved_bytes = 0
+    changed = []
+    originals = []
+    with locking.library_lock(directory).exclusive():
+        for sha256, group in groups.items():
+            if hard_link:
+                for path in group[1:]:
+                    if os.path.samefile(group[0], path):
+                        continue
+                    duplicates += 1
+                    saved_bytes += os.path.getsize(path)
+                    if not dry_run:
+                        link(group[0], path)
+                continue
+            duplicates += len(group) - 1
+            saved_bytes += sum(os.path.getsize(path) for path in group[1:])
+            destination = stored_path(directory, group[0], sha256)
+            for path in group:
+                for book in references[path]:
+                    thumbnail = os.path.relpath(destination, os.path.realpath(os.path.dirname(book.path)))
+                    if book.document.metadata["thumbnail"] != thumbnail:
+                        book.document.metadata["thumbnail"] = thumbnail
+                        changed.append(book)
+                if not dry_run and path != destination:
+                    copy(directory, path, sha256)
+                    # Anything in the store may be shared, and is left for `prune` to tidy up.
+                    if not is_stored(directory, path):
+                        originals.append(path)
+        # The originals only go once every book has been saved pointing at the store, so a save that fails part way
+        # leaves the rest of the books with the covers they had.
+        if not dry_run:
+            storage.save_many(changed)
+            for path in originals:
+                os.remove(path)
+    return Summary(covers=len(paths), duplicates=duplicates, bytes=saved_bytes, books=len(changed))
+
+
+def prune(library, directory, dry_run=False):
+    # Covers in the store can be shared, so they're only removed once nothing refers to them.
+    if not has_store(directory):
+        return []
+    referenced = {os.path.realpath(cover_path(book)) for book in library if cover_path(book) is not None}
+    unreferenced = []
+    with locking.library_lock(directory).exclusive(), os.scandir(store_path(directory)) as entries:
+        for entry in entries:
+            if entry.is_file() and os.path.realpath(entry.path) not in referenced:
+                unreferenced.append(entry.path)
+                if not dry_run:
+                    os.remove(entry.path)
+    return unreferenced
@@ -0,0 +1,201 @@
+import json
+import os
+import signal
+import socketserver
+import sys
+import time
+
+import books
+import storage
+
+
+POLL_INTERVAL = 1.0
+
+
+class Daemon(object):
+
+    def __init__(self, library_storage, interval=POLL_INTERVAL):
+        self.storage = library_storage
+        self.interval = interval
+        self.books = {}
+        self.records = {}
+        self.quarantined = {}
+        self.database_version = None
+        self.last_refresh = 0.0
+        self.methods = {
+            "ping": self.ping,
+            "list": self.list,
+            "search": self.search,
+            "get": self.get,
+            "update": self.update,
+            "update_many": self.update_many,
+            "delete": self.delete,
+            "quarantined": self.list_quarantined,
+        }
+        self.refresh()
+
+    def add(self, book):
+        self.books[book.path] = book
+        record = storage.encode_document(book.document)
+        record["path"] = book.path
+        record["title"] = book.title
+        self.records[book.path] = record
+
+    def remove(self, path):
+        self.books.pop(path, None)
+        self.records.pop(path, None)
+
+    def refresh(self):
+        self.last_refresh = time.monotonic()
+        if isinstance(self.storage, storage.MarkdownStorage):
+            self.refresh_markdown()
+            return
+        # Databases can't be checked book by book, so reload everything whenever the file changes underneath us.
+        database_version = storage.version(storage.stat(self.storage.path))
+        if database_version != self.database_version:
+            self.books = {}
+            self.records = {}
+            for book in self.storage.load():
+                self.add(book)
+            self.quarantined = {path: (None, reason) for path, reason in self.storage.quarantined}
+            self.database_version = database_version
+
+    def refresh_markdown(self):
+        entries = {entry.path: entry.stat() for entry in books.scan(self.storage.directory)}
+        for path in list(self.books):
+            if path not in entries:
+                self.remove(path)
+        for path in list(self.quarantined):
+            if path not in entries:
+                del self.quarantined[path]
+        for path, entry_stat in entries.items():
+            book = self.books.get(path)
+            if book is not None and storage.version(book.stat) == storage.version(entry_stat):
+                continue
+            if path in self.quarantined and self.quarantined[path][0] == storage.version(entry_stat):
+                continue
+            try:
+                book = books.Book(path, stat=entry_stat, storage=self.storage)
+                books.validate(book)
+            except books.LOAD_ERRORS as e:
+                # Quarantined until the file changes again; it may well be half way through being written.
+                self.remove(path)
+                self.quarantined[path] = (storage.version(entry_stat), str(e) or e.__class__.__name__)
+                continue
+            self.quarantined.pop(path, None)
+            self.add(book)
+
+    def poll(self):
+        if time.monotonic() - self.last_refresh >= self.interval:
+            self.refresh()
+
+    def written(self, path, document):
+        self.add(books.Book(path, stat=storage.stat(path), document=document, storage=self.storage))
+        if not isinstance(self.storage, storage.MarkdownStorage):
+            self.database_version = storage.version(storage.stat(self.storage.path))
+
+    def sorted_records(self, paths):
+        return sorted((self.records[path] for path in paths), key=lambda record: record["title"])
+
+    def find(self, identifier):
+        for book in self.books.values():
+            if identifier in books.identifiers(book):
+                return book
+        raise KeyError(f"No book matching '{identifier}'.")
+
+    def list_quarantined(self):
+        return [[path, reason] for path, (version, reason) in sorted(self.quarantined.items())]
+
+    def ping(self):
+        return os.getpid()
+
+    def list(self, status=None):
+        paths = self.books.keys()
+        if status is not None:
+            status = books.STATUS_NAMES[status]
+            paths = [path for path, book in self.books.items() if book.status == status]
+        return self.sorted_records(paths)
+
+    def search(self, query):
+        terms = query.lower().split()
+        paths = [path for path, book in self.books.items()
+                 if all(term in " ".join([book.title] + book.document.metadata.get("authors", [])).lower()
+                        for term in terms)]
+        return self.sorted_records(paths)
+
+    def get(self, identifier):
+        return self.records[self.find(identifier).path]
+
+    def resolve(self, path, document, base):
+        document = storage.decode_document(document)
+        if base is None or path not in self.books:
+            return document
+        return storage.resolve(path, storage.decode_document(base), document, self.books[path].document)
+
+    def update(self, path, document, base=None):
+        return self.update_many([{"path": path, "document": document, "base": base}])[0]
+
+    def update_many(self, books):
+        documents = [(book["path"], self.resolve(book["path"], book["document"], book.get("base"))) for book in books]
+        self.storage.write_many(documents)
+        for path, document in documents:
+            self.written(path, document)
+        return [self.records[path] for path, document in documents]
+
+    def delete(self, path):
+        book = self.books.get(path)
+        if book is None:
+            raise KeyError(f"No book at '{path}'.")
+        self.storage.delete(book)
+        self.remove(path)
+        if not isinstance(self.storage, storage.MarkdownStorage):
+            self.database_version = storage.version(storage.stat(self.storage.path))
+        return path
+
+    def call(self, request):
+        method = self.methods[request.pop("method")]
+        if method != self.ping:
+            # Other processes (git, editors, the tools) write to the library too, so make sure requests see their
+            # changes, and updates are merged with them.
+            self.refresh()
+        return method(**request)
+
+
+class Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            response = {"result": self.server.daemon.call(json.loads(self.rfile.readline()))}
+        except Exception as e:
+            response = {"error": str(e) or e.__class__.__name__, "type": e.__class__.__name__}
+        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+class Server(socketserver.UnixStreamServer):
+
+    def __init__(self, path, daemon):
+        self.daemon = daemon
+        super(Server, self).__init__(path, Handler)
+
+    def service_actions(self):
+        self.daemon.poll()
+
+
+def serve(library_storage, path=storage.SOCKET_PATH, interval=POLL_INTERVAL):
+    if os.path.exists(path):
+        if storage.RemoteStorage(library_storage.directory, path=path).is_running():
+            exit(f"A daemon is already listening on '{path}'.")
+        os.remove(path)
+    daemon = Daemon(library_storage, interval=interval)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Leave through `finally` on SIGTERM too, so the socket doesn't outlive us.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    with Server(path, daemon) as server:
+        os.chmod(path, 0o600)
+        print(f"Serving {len(daemon.books)} book(s) on '{path}'.", flush=True)
+        try:
+            server.serve_forever(poll_interval=min(interval, 0.5))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(path)
@@ -0,0 +1,177 @@
+import concurrent.futures
+import csv
+import functools
+import hashlib
+import io
+import json
+import os
+import shutil
+
+import jinja2
+
+import books
+import codec
+import covers
+
+
+TEMPLATES_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+MANIFEST_NAME = ".manifest.json"
+INDEX_TEMPLATES = ["index.html", "books.json", "books.csv"]
+# Below this many pages, starting worker processes costs more than rendering them here.
+PROCESS_THRESHOLD = 16
+
+
+def csv_filter(values):
+    output = io.StringIO()
+    csv.writer(output, lineterminator="").writerow(["" if value is None else value for value in values])
+    return output.getvalue()
+
+
+@functools.lru_cache()
+def environment(templates_directory):
+    environment = jinja2.Environment(loader=jinja2.FileSystemLoader(templates_directory),
+                                     autoescape=jinja2.select_autoescape(["html"]))
+    environment.filters["csv"] = csv_filter
+    return environment
+
+
+def render(templates_directory, template, destination, **context):
+    contents = environment(templates_directory).get_template(template).render(**context)
+    with open(destination, "w") as fh:
+        fh.write(contents)
+    return destination
+
+
+def digest(paths):
+    sha256 = hashlib.sha256()
+    for path in paths:
+        sha256.update(path.encode("utf-8"))
+        with open(path, "rb") as fh:
+            for chunk in iter(lambda: fh.read(65536), b""):
+                sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def text(value):
+    return str(value) if value is not None else None
+
+
+class Page(object):
+
+    def __init__(self, book):
+        self.book = book
+        # Sharded libraries can have books with the same name in different directories, so the shard is part of the
+        # slug; books at the top of the library keep their plain basename.
+        directory = book.storage.directory if getattr(book, "storage", None) is not None else os.path.dirname(book.path)
+        relative_path = os.path.relpath(os.path.splitext(book.path)[0], directory)
+        self.slug = "-".join(relative_path.split(os.sep))
+        thumbnail = book.document.metadata.get("thumbnail")
+        self.cover_path = os.path.join(os.path.dirname(book.path), thumbnail) if thumbnail is not None else None
+        if self.cover_path is not None and not os.path.exists(self.cover_path):
+            self.cover_path = None
+        # Covers are written out under their content digest, since books in different shards can have covers with the
+        # same name.
+        self.cover = None
+        if self.cover_path is not None:
+            _, ext = os.path.splitext(self.cover_path)
+            self.cover = covers.digest(self.cover_path) + (ext.lower() or ".jpg")
+
+    @property
+    def digest(self):
+        # The serialised document rather than the file, which is stale (or missing) for books kept in the database.
+        sha256 = hashlib.sha256()
+        sha256.update(codec.dumps(self.book.document).encode("utf-8"))
+        if self.cover is not None:
+            sha256.update(self.cover.encode("utf-8"))
+        return sha256.hexdigest()
+
+    @property
+    def context(self):
+        metadata = self.book.document.metadata
+        return {
+            "slug": self.slug,
+            "title": self.book.title,
+            "authors": metadata.get("authors", []),
+            "status": self.book.status.value[1],
+            "date": text(self.book.date),
+            "end_date": text(self.book.end_date),
+            "link": metadata.get("link"),
+            "ids": {key: text(value) for key, value in metadata.get("ids", {}).items()},
+            "cover": self.cover,
+            "content": self.book.document.content,
+        }
+
+
+class Exporter(object):
+
+    def __init__(self, output, templates_directory=None, jobs=None):
+        self.output = os.path.abspath(output)
+        self.templates_directory = os.path.abspath(templates_directory or TEMPLATES_DIRECTORY)
+        self.jobs = jobs or os.cpu_count()
+        self.manifest_path = os.path.join(self.output, MANIFEST_NAME)
+
+    def load_manifest(self):
+        try:
+            with open(self.manifest_path) as fh:
+                return json.load(fh)
+        except FileNotFoundError:
+            return {"templates": None, "books": {}}
+
+    def save_manifest(self, manifest):
+        with open(self.manifest_path, "w") as fh:
+            json.dump(manifest, fh, indent=4, sort_keys=True)
+
+    def templates_digest(self):
+        with os.scandir(self.templates_directory) as entries:
+            return digest(sorted(entry.path for entry in entries if entry.is_file()))
+
+    def export(self, library, force=False):
+        os.makedirs(os.path.join(self.output, "books"), exist_ok=True)
+        os.makedirs(os.path.join(self.output, "covers"), exist_ok=True)
+
+        manifest = self.load_manifest()
+        templates = self.templates_digest()
+        if templates != manifest["templates"]:
+            force = True
+
+        pages = [Page(book) for book in library]
+        hashes = {page.slug: page.digest for page in pages}
+        changed = [page for page in pages if force or manifest["books"].get(page.slug) != hashes[page.slug]]
+
+        # Remove the pages and covers of books that are no longer in the library.
+        for slug in manifest["books"]:
+            if slug not in hashes:
+                path = os.path.join(self.output, "books", f"{slug}.html")
+                if os.path.exists(path):
+                    os.remove(path)
+        names = {page.cover for page in pages if page.cover is not None}
+        for cover in os.listdir(os.path.join(self.output, "covers")):
+            if cover not in names:
+                os.remove(os.path.join(self.output, "covers", cover))
+
+        for page in changed:
+            if page.cover is not None:
+                shutil.copyfile(page.cover_path, os.path.join(self.output, "covers", page.cover))
+
+        jobs = [(self.templates_directory, "book.html", os.path.join(self.output, "books", f"{page.slug}.html"),
+                 {"book": page.context}) for page in changed]
+        if changed or set(hashes) != set(manifest["books"]):
+            contexts = [page.context for page in pages]
+            shelves = [(status.value[1], [context for context in contexts if context["status"] == status.value[1]])
+                       for status in books.Status]
+            jobs.extend([(self.templates_directory, template, os.path.join(self.output, template),
+                          {"books": contexts, "shelves": [shelf for shelf in shelves if shelf[1]]})
+                         for template in INDEX_TEMPLATES])
+
+        if self.jobs > 1 and len(jobs) >= PROCESS_THRESHOLD:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.jobs) as executor:
+                futures = [executor.submit(render, templates_directory, template, destination, **context)
+                           for templates_directory, template, destination, context in jobs]
+                for future in futures:
+                    future.result()
+        else:
+            for templates_directory, template, destination, context in jobs:
+                render(templates_directory, template, destination, **context)
+
+        self.save_manifest({"templates": templates, "books": hashes})
+        return changed
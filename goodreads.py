@@ -0,0 +1,235 @@
+import csv
+import datetime
+import functools
+import hashlib
+import os
+import threading
+import time
+import urllib.parse
+
+import dateutil.tz
+import lxml.etree
+import lxml.html
+import requests
+
+import batch
+import books
+import googlebooks
+import metrics
+import profiling
+import utilities
+
+
+BOOK_URL = "https://www.goodreads.com/book/show/{id}"
+CACHE_DIRECTORY = os.path.expanduser("~/.cache/bookshelf/goodreads")
+COVER_XPATH = lxml.etree.XPath('//div[@class="editionCover"]/img/@src')
+# What fetching and parsing a book page, and downloading its cover, can fail with.
+COVER_ERRORS = (requests.RequestException, OSError, ValueError, lxml.etree.LxmlError, utilities.BookNotFound)
+
+
+SHELVES = {
+    "to-read": books.Status.TO_READ,
+    "currently-reading": books.Status.CURRENTLY_READING,
+    "read": books.Status.READ,
+    "abandoned": books.Status.ABANDONED_UNKNOWN,
+    "did-not-finish": books.Status.ABANDONED_UNKNOWN,
+    "dnf": books.Status.ABANDONED_UNKNOWN,
+}
+
+
+def isbn(value):
+    # Goodreads writes ISBNs as Excel formulas (`="0123456789"`) to keep their leading zeros.
+    value = value.strip().lstrip("=").strip('"')
+    return value or None
+
+
+def date(value):
+    if not value:
+        return None
+    return datetime.datetime.strptime(value.strip(), "%Y/%m/%d").replace(tzinfo=dateutil.tz.tzlocal())
+
+
+class Row(object):
+
+    def __init__(self, row):
+        self.id = row["Book Id"].strip()
+        self.title = row["Title"].strip()
+        self.authors = [author.strip() for author in [row.get("Author", "")] + row.get("Additional Authors", "").split(",")
+                        if author.strip()]
+        self.isbn = isbn(row.get("ISBN", ""))
+        self.isbn_13 = isbn(row.get("ISBN13", ""))
+        self.shelf = row.get("Exclusive Shelf", "").strip() or "to-read"
+        self.date_read = date(row.get("Date Read"))
+        self.date_added = date(row.get("Date Added"))
+
+
+def rows(stream):
+    for row in csv.DictReader(stream):
+        yield Row(row)
+
+
+class GoodreadsBook(object):
+
+    def __init__(self, row, new_book=None):
+        self.row = row
+        if new_book is None:
+            new_book = books.ManualBook(title=row.title, author=None, thumbnail=None)
+            new_book.authors = row.authors
+        self.new_book = new_book
+
+    @property
+    def thumbnail(self):
+        return self.new_book.thumbnail
+
+    @property
+    def basename(self):
+        return self.new_book.basename
+
+    @property
+    def metadata(self):
+        metadata = dict(self.new_book.metadata)
+        metadata["ids"] = dict(metadata.get("ids", {}), goodreads=self.row.id)
+        if self.row.isbn is not None:
+            metadata["ids"].setdefault("isbn_10", self.row.isbn)
+        if self.row.isbn_13 is not None:
+            metadata["ids"].setdefault("isbn_13", self.row.isbn_13)
+
+        status = SHELVES[self.row.shelf]
+        metadata["status"] = status.value[0]
+        if status == books.Status.CURRENTLY_READING:
+            metadata["date"] = (self.row.date_added or utilities.tznow()).isoformat()
+        elif status == books.Status.READ:
+            if self.row.date_read is not None:
+                metadata["end_date"] = self.row.date_read.isoformat()
+            else:
+                metadata["status"] = books.Status.READ_UNKNOWN.value[0]
+        return metadata
+
+
+class Importer(batch.Importer):
+
+    def lookup(self, row):
+        for value in (row.isbn_13, row.isbn):
+            if value is None:
+                continue
+            try:
+                return googlebooks.search_isbn(value)
+            except utilities.BookNotFound:
+                pass
+        return None
+
+    def resolve(self, row):
+        if row.id in self.known:
+            return batch.Result("skipped", row.id, f"already in the library as '{self.known[row.id].title}'", None)
+        if row.shelf not in SHELVES:
+            return batch.Result("failed", row.id, f"unknown shelf '{row.shelf}'", None)
+        try:
+            new_book = self.lookup(row)
+            if new_book is not None and new_book.id in self.known:
+                return batch.Result("skipped", row.id,
+                                    f"already in the library as '{self.known[new_book.id].title}'", None)
+            goodreads_book = GoodreadsBook(row, new_book)
+            keys = [row.id, goodreads_book.basename] + ([new_book.id] if new_book is not None else [])
+            if not self.claim(*keys):
+                return batch.Result("skipped", row.id, "same book as an earlier row", None)
+            path, document = books.prepare_book(self.directory, goodreads_book, layout=self.layout)
+        except batch.RESOLVE_ERRORS as e:
+            return batch.Result("failed", row.id, str(e) or e.__class__.__name__, None)
+        return batch.Result("added", row.id, path, document)
+
+
+class Client(object):
+
+    def __init__(self, cache_directory=CACHE_DIRECTORY, rate=1.0, workers=4):
+        self.cache_directory = cache_directory
+        self.interval = 1.0 / rate if rate else 0.0
+        self.lock = threading.Lock()
+        self.next_request = 0.0
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def wait(self):
+        # Reserve the next slot under the lock and sleep outside it, so requests are spaced out without serialising
+        # the threads that only need the cache.
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_request - now
+            self.next_request = max(now, self.next_request) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+    def page(self, url):
+        path = os.path.join(self.cache_directory, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".html")
+        try:
+            with open(path, "rb") as fh:
+                content = fh.read()
+            metrics.inc("bookshelf_goodreads_pages_total", result="cache")
+            return content
+        except FileNotFoundError:
+            pass
+        metrics.inc("bookshelf_goodreads_pages_total", result="network")
+        self.wait()
+        with profiling.span("goodreads.page", url=url):
+            response = self.session.get(url)
+            response.raise_for_status()
+        os.makedirs(self.cache_directory, exist_ok=True)
+        with open(path + ".tmp", "wb") as fh:
+            fh.write(response.content)
+        os.replace(path + ".tmp", path)
+        return response.content
+
+    def download(self, url, destination):
+        with profiling.span("goodreads.download", url=url):
+            with self.session.get(url, stream=True) as response:
+                response.raise_for_status()
+                with open(destination, "wb") as fh:
+                    for chunk in response.iter_content(65536):
+                        fh.write(chunk)
+
+
+def cover_url(html):
+    urls = COVER_XPATH(lxml.html.document_fromstring(html))
+    return str(urls[0]) if urls else None
+
+
+def download_cover(client, url, basename):
+    cover = cover_url(client.page(url))
+    if cover is None:
+        raise utilities.BookNotFound(f"No cover on '{url}'.")
+    _, ext = os.path.splitext(urllib.parse.urlparse(cover).path)
+    destination = f"{basename}{ext or '.jpg'}"
+    client.download(cover, destination)
+    return destination
+
+
+def missing_covers(library):
+    return [book for book in library
+            if "goodreads" in book.document.metadata.get("ids", {}) and "thumbnail" not in book.document.metadata]
+
+
+def fetch_cover(client, book):
+    url = BOOK_URL.format(id=book.document.metadata["ids"]["goodreads"])
+    basename = os.path.splitext(book.path)[0] + "-cover"
+    try:
+        return book, os.path.basename(download_cover(client, url, basename)), None
+    except COVER_ERRORS as e:
+        return book, None, str(e) or e.__class__.__name__
+
+
+def download_covers(storage, library, client, jobs=4):
+    results = []
+    updated = []
+    for book, thumbnail, error in utilities.bounded_map(functools.partial(fetch_cover, client),
+                                                        missing_covers(library),
+                                                        workers=jobs):
+        identifier = os.path.splitext(os.path.basename(book.path))[0]
+        if thumbnail is None:
+            results.append(batch.Result("failed", identifier, error, None))
+            continue
+        book.document.metadata["thumbnail"] = thumbnail
+        updated.append(book)
+        results.append(batch.Result("updated", identifier, thumbnail, book.document))
+    storage.save_many(updated)
+    return results
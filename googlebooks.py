@@ -1,61 +1,63 @@
 import requests
 
+import isbns
+import profiling
 import utilities
 
 
-class GoogleBook(object):
-
-    def __init__(self, data):
-        self._data = data
+API_URL = "https://www.googleapis.com/books/v1/volumes"
+MAX_RESULTS = 40
 
-    @property
-    def id(self):
-        return self._data["id"]
-
-    @property
-    def language(self):
-        return self._data["volumeInfo"]["language"]
+# Everything GoogleBook reads, so searches don't pay for descriptions, prices, sale info and the rest.
+VOLUME_FIELDS = "id,volumeInfo(title,subtitle,authors,language,canonicalVolumeLink,imageLinks/thumbnail," \
+                "industryIdentifiers)"
+SEARCH_FIELDS = f"totalItems,items({VOLUME_FIELDS})"
 
-    @property
-    def volume_info(self):
-        return self._data["volumeInfo"]
 
-    @property
-    def title(self):
-        if "subtitle" in self.volume_info:
-            return f"{self.volume_info['title']}: {self.volume_info['subtitle']}"
-        return self.volume_info["title"]
+class GoogleBook(object):
+    # The fields the picker and import_book use, pulled out of a volume once. The full API record is only fetched
+    # if something asks for `data`.
 
-    @property
-    def authors(self):
-        try:
-            return self._data["volumeInfo"]["authors"]
-        except KeyError:
-            return []
+    __slots__ = ("id", "volume_title", "subtitle", "title", "authors", "language", "url", "image", "thumbnail",
+                 "isbn", "isbn_13", "_data")
 
-    @property
-    def url(self):
-        return self._data["volumeInfo"]["canonicalVolumeLink"]
-
-    @property
-    def thumbnail(self):
-        if "imageLinks" not in self._data["volumeInfo"]:
-            return None
-        return self._data["volumeInfo"]["imageLinks"]["thumbnail"] + "&fife=w400-h600"
+    def __init__(self, data):
+        volume_info = data.get("volumeInfo", {})
+        identifiers = {identifier["type"]: identifier["identifier"]
+                       for identifier in volume_info.get("industryIdentifiers", [])}
+        self.id = data["id"]
+        self.volume_title = volume_info.get("title", "")
+        self.subtitle = volume_info.get("subtitle")
+        self.title = f"{self.volume_title}: {self.subtitle}" if self.subtitle else self.volume_title
+        self.authors = volume_info.get("authors", [])
+        self.language = volume_info.get("language", "")
+        self.url = volume_info.get("canonicalVolumeLink")
+        self.image = volume_info.get("imageLinks", {}).get("thumbnail")
+        self.thumbnail = self.image + "&fife=w400-h600" if self.image is not None else None
+        self.isbn = identifiers.get("ISBN_10")
+        self.isbn_13 = identifiers.get("ISBN_13")
+        self._data = None
 
     @property
-    def isbn(self):
-        for identifier in self._data["volumeInfo"]["industryIdentifiers"]:
-            if identifier["type"] == "ISBN_10":
-                return identifier["identifier"]
-        raise KeyError("isbn")
+    def record(self):
+        # The projected fields in the API's own shape, which is what the catalog keeps.
+        volume_info = {"title": self.volume_title, "authors": self.authors, "language": self.language}
+        if self.subtitle:
+            volume_info["subtitle"] = self.subtitle
+        if self.url is not None:
+            volume_info["canonicalVolumeLink"] = self.url
+        if self.image is not None:
+            volume_info["imageLinks"] = {"thumbnail": self.image}
+        volume_info["industryIdentifiers"] = [{"type": name, "identifier": value}
+                                              for name, value in (("ISBN_10", self.isbn), ("ISBN_13", self.isbn_13))
+                                              if value is not None]
+        return {"id": self.id, "volumeInfo": volume_info}
 
     @property
-    def isbn_13(self):
-        for identifier in self._data["volumeInfo"]["industryIdentifiers"]:
-            if identifier["type"] == "ISBN_13":
-                return identifier["identifier"]
-        raise KeyError("isbn_13")
+    def data(self):
+        if self._data is None:
+            self._data = volume(self.id)
+        return self._data
 
     @property
     def metadata(self):
@@ -68,14 +70,12 @@ class GoogleBook(object):
                 "google_books": self.id,
             }
         }
-        try:
+        if self.url is None:
+            del metadata["link"]
+        if self.isbn is not None:
             metadata["ids"]["isbn_10"] = self.isbn
-        except KeyError:
-            pass
-        try:
+        if self.isbn_13 is not None:
             metadata["ids"]["isbn_13"] = self.isbn_13
-        except KeyError:
-            pass
         return metadata
 
     @property
@@ -83,10 +83,33 @@ class GoogleBook(object):
         return utilities.basename(f"{self.title} {' '.join(self.authors)}")
 
 
-def search(query, index=0):
-    response = requests.get("https://www.googleapis.com/books/v1/volumes",
-                            params={"q": query, "startIndex": index})
-    response_data = response.json()
-    if response_data["totalItems"] < 1:
+def search(query, index=0, count=MAX_RESULTS):
+    # `index` is the offset of the first result, not a page number; the API won't return more than 40 at a time.
+    with profiling.span("googlebooks.search", query=query, index=index, count=count):
+        response = requests.get(API_URL,
+                                params={"q": query, "startIndex": index, "maxResults": min(count, MAX_RESULTS),
+                                        "fields": SEARCH_FIELDS})
+        response_data = response.json()
+    if response_data["totalItems"] < 1 or not response_data.get("items"):
         raise utilities.BookNotFound()
     return [GoogleBook(data) for data in response_data['items']]
+
+
+def volume(identifier):
+    with profiling.span("googlebooks.volume", id=identifier):
+        try:
+            response = requests.get(f"{API_URL}/{identifier}")
+        except requests.exceptions.ConnectionError:
+            raise utilities.BookNotFound()
+    if response.status_code != 200:
+        raise utilities.BookNotFound()
+    return response.json()
+
+
+def search_isbn(isbn):
+    # Volumes only list some of their ISBNs, in either form, so they're compared as ISBN-13s.
+    isbn = isbns.normalize(isbn) or isbn
+    for book in search(query=f"isbn:{isbn}"):
+        if isbn in isbns.volume_isbns(book):
+            return book
+    raise utilities.BookNotFound()
@@ -0,0 +1,152 @@
+import re
+
+import metrics
+import utilities
+
+
+ISBN_10 = re.compile(r"^[0-9]{9}[0-9X]$")
+ISBN_13 = re.compile(r"^97[89][0-9]{10}$")
+PREFIX = re.compile(r"^isbn(?:-1[03])?:?", re.IGNORECASE)
+
+
+class InvalidISBN(ValueError):
+    pass
+
+
+class InLibrary(Exception):
+
+    def __init__(self, book):
+        super(InLibrary, self).__init__(f"'{book.title}' is already in the library.")
+        self.book = book
+
+
+def compact(value):
+    return re.sub(r"[\s-]", "", str(value)).upper()
+
+
+def isbn_10_check_digit(digits):
+    check = (11 - sum((10 - index) * int(digit) for index, digit in enumerate(digits[:9]))) % 11
+    return "X" if check == 10 else str(check)
+
+
+def isbn_13_check_digit(digits):
+    return str((10 - sum(int(digit) * (3 if index % 2 else 1) for index, digit in enumerate(digits[:12]))) % 10)
+
+
+def is_valid(value):
+    if ISBN_10.match(value):
+        return value[9] == isbn_10_check_digit(value)
+    if ISBN_13.match(value):
+        return value[12] == isbn_13_check_digit(value)
+    return False
+
+
+def to_13(value):
+    # The canonical form: ISBN-10s are ISBN-13s with the 978 prefix and a different check digit.
+    if len(value) == 13:
+        return value
+    digits = "978" + value[:9]
+    return digits + isbn_13_check_digit(digits)
+
+
+def to_10(value):
+    if len(value) == 10:
+        return value
+    if not value.startswith("978"):
+        return None
+    digits = value[3:12]
+    return digits + isbn_10_check_digit(digits)
+
+
+def normalize(value):
+    # Returns the ISBN-13 for anything that's a valid ISBN, and None otherwise.
+    value = compact(value)
+    return to_13(value) if is_valid(value) else None
+
+
+def parse(query):
+    # None if the query isn't shaped like an ISBN; a mistyped one raises, rather than becoming a free text search.
+    value = compact(PREFIX.sub("", query.strip()))
+    explicit = PREFIX.match(query.strip()) is not None
+    if not (ISBN_10.match(value) or re.match(r"^[0-9]{13}$", value)):
+        if explicit:
+            raise InvalidISBN(f"'{query}' isn't an ISBN.")
+        return None
+    if not is_valid(value):
+        raise InvalidISBN(f"'{value}' isn't a valid ISBN; check for a typo.")
+    return to_13(value)
+
+
+def book_isbns(book):
+    metadata = book.document.metadata
+    values = [metadata.get("isbn"), metadata.get("isbn_13")]
+    values.extend(metadata.get("ids", {}).get(key) for key in ("isbn_10", "isbn_13"))
+    for value in values:
+        if value is not None:
+            isbn = normalize(value)
+            if isbn is not None:
+                yield isbn
+
+
+def index(library):
+    return {isbn: book for book in library for isbn in book_isbns(book)}
+
+
+def volume_isbns(volume):
+    for value in (volume.isbn, volume.isbn_13):
+        isbn = normalize(value) if value is not None else None
+        if isbn is not None:
+            yield isbn
+
+
+class Lookup(object):
+    # Resolves ISBNs to Google Books volumes, first from the library (which raises InLibrary), then the catalog, and
+    # only then with a targeted `isbn:` search. Answers are remembered for the life of the lookup.
+
+    def __init__(self, load_library=None, catalog=None):
+        self.load_library = load_library
+        self.catalog = catalog
+        self.library_index = None
+        self.cache = {}
+
+    def check_library(self, isbn):
+        if self.load_library is None:
+            return
+        if self.library_index is None:
+            self.library_index = index(self.load_library())
+        if isbn in self.library_index:
+            metrics.inc("bookshelf_isbn_lookups_total", result="library")
+            raise InLibrary(self.library_index[isbn])
+
+    def volumes(self, isbn):
+        if isbn in self.cache:
+            metrics.inc("bookshelf_isbn_lookups_total", result="cache")
+            return self.cache[isbn]
+        volumes = []
+        if self.catalog is not None:
+            for value in filter(None, (isbn, to_10(isbn))):
+                volumes.extend(self.catalog.find_isbn(value))
+        offline = self.catalog is not None and self.catalog.offline
+        metrics.inc("bookshelf_isbn_lookups_total", result="catalog" if volumes else "miss" if offline else "network")
+        if not volumes and not offline:
+            import googlebooks
+            try:
+                volumes = googlebooks.search(query=f"isbn:{isbn}")
+            except utilities.BookNotFound:
+                volumes = []
+            if self.catalog is not None and volumes:
+                self.catalog.add_google_books(volumes)
+        unique = {}
+        for volume in volumes:
+            if isbn in volume_isbns(volume):
+                unique.setdefault(volume.id, volume)
+        self.cache[isbn] = list(unique.values())
+        return self.cache[isbn]
+
+    def __call__(self, query):
+        # None when the query isn't an ISBN at all, otherwise the matching volumes.
+        isbn = parse(query)
+        if isbn is None:
+            return None
+        self.check_library(isbn)
+        return self.volumes(isbn)
@@ -0,0 +1,61 @@
+import contextlib
+import fcntl
+import hashlib
+import os
+import tempfile
+import threading
+
+
+class LibraryLock(object):
+    # Advisory reader/writer lock shared by every process using a library: any number of readers, or one writer.
+    # The lock file lives outside the library so it never ends up in a commit.
+
+    def __init__(self, directory):
+        directory = os.path.realpath(directory)
+        digest = hashlib.sha1(directory.encode("utf-8")).hexdigest()[:16]
+        self.path = os.path.join(tempfile.gettempdir(), f"bookshelf-{digest}.lock")
+        self.fd = None
+        self.mode = None
+        self.depth = 0
+        self.lock = threading.RLock()
+
+    @contextlib.contextmanager
+    def hold(self, mode):
+        # flock locks belong to the open file, so nested holds in one process share it rather than deadlocking. A
+        # shared hold inside an exclusive one is already covered; the reverse upgrades the lock.
+        with self.lock:
+            if self.fd is None:
+                self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            previous = self.mode
+            if previous != fcntl.LOCK_EX and previous != mode:
+                fcntl.flock(self.fd, mode)
+                self.mode = mode
+            self.depth += 1
+            try:
+                yield
+            finally:
+                self.depth -= 1
+                if self.depth == 0:
+                    fcntl.flock(self.fd, fcntl.LOCK_UN)
+                    self.mode = None
+                elif previous is not None and previous != self.mode:
+                    fcntl.flock(self.fd, previous)
+                    self.mode = previous
+
+    def shared(self):
+        return self.hold(fcntl.LOCK_SH)
+
+    def exclusive(self):
+        return self.hold(fcntl.LOCK_EX)
+
+
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def library_lock(directory):
+    key = os.path.realpath(directory)
+    with _locks_lock:
+        if key not in _locks:
+            _locks[key] = LibraryLock(directory)
+        return _locks[key]
@@ -0,0 +1,192 @@
+import bisect
+import collections
+import fcntl
+import json
+import os
+import re
+import threading
+import time
+
+import profiling
+
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SPAN_DURATION = "bookshelf_span_duration_seconds"
+SPAN_ERRORS = "bookshelf_span_errors_total"
+
+SAMPLE = re.compile(r"^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{.*\})?\s+(\S+)$")
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f"{name}=\"{value}\"" for (name, _), value in zip(labels, escaped)) + "}"
+
+
+def format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Histogram(object):
+
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(BUCKETS + ("+Inf",), self.counts):
+            total += count
+            yield bound, total
+
+
+class Registry(object):
+    # Counters, gauges and latency histograms for one run, keyed by name and labels. It also listens to profiling
+    # spans, so everything already timed there gets a histogram without any extra instrumentation.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.defaultdict(float)
+        self.gauges = {}
+        self.histograms = collections.defaultdict(Histogram)
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[(name, label_key(labels))] += value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, label_key(labels))] = value
+
+    def observe(self, name, value, **labels):
+        with self.lock:
+            self.histograms[(name, label_key(labels))].observe(value)
+
+    def record(self, name, start, end, args):
+        self.observe(SPAN_DURATION, end - start, span=name)
+        if "error" in args:
+            self.inc(SPAN_ERRORS, span=name, error=args["error"])
+
+    def families(self):
+        # `{family: (type, {sample: value})}` in the Prometheus text format's terms, samples in the order they're
+        # written.
+        families = collections.OrderedDict()
+
+        def samples(name, kind):
+            return families.setdefault(name, (kind, collections.OrderedDict()))[1]
+
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                samples(name, "counter")[name + format_labels(labels)] = value
+            for (name, labels), value in sorted(self.gauges.items()):
+                samples(name, "gauge")[name + format_labels(labels)] = value
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                buckets = samples(name, "histogram")
+                for bound, count in histogram.cumulative():
+                    le = bound if isinstance(bound, str) else format_value(bound)
+                    buckets[f"{name}_bucket{format_labels(labels + (('le', le),))}"] = count
+                buckets[f"{name}_sum{format_labels(labels)}"] = histogram.sum
+                buckets[f"{name}_count{format_labels(labels)}"] = histogram.count
+        return families
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "counters": [{"name": name, "labels": dict(labels), "value": value}
+                             for (name, labels), value in sorted(self.counters.items())],
+                "gauges": [{"name": name, "labels": dict(labels), "value": value}
+                           for (name, labels), value in sorted(self.gauges.items())],
+                "histograms": [{"name": name, "labels": dict(labels),
+                                "buckets": {str(bound): count for bound, count in histogram.cumulative()},
+                                "sum": histogram.sum, "count": histogram.count}
+                               for (name, labels), histogram in sorted(self.histograms.items())],
+            }
+
+
+def read_prometheus(path):
+    families = collections.OrderedDict()
+    try:
+        with open(path) as fh:
+            lines = fh.read().splitlines()
+    except FileNotFoundError:
+        return families
+    samples = None
+    for line in lines:
+        if line.startswith("# TYPE "):
+            _, _, name, kind = line.split(" ", 3)
+            samples = families.setdefault(name, (kind, collections.OrderedDict()))[1]
+            continue
+        match = SAMPLE.match(line)
+        if match and samples is not None:
+            samples[match.group(1) + (match.group(2) or "")] = float(match.group(3))
+    return families
+
+
+def write_prometheus(registry, path):
+    # node_exporter's textfile collector reads the whole file, so counters and histograms carry on from the totals of
+    # earlier runs, gauges take the latest value, and the file is replaced rather than rewritten in place.
+    with open(f"{path}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        families = read_prometheus(path)
+        for name, (kind, samples) in registry.families().items():
+            previous = families.setdefault(name, (kind, collections.OrderedDict()))[1]
+            for sample, value in samples.items():
+                previous[sample] = value if kind == "gauge" else previous.get(sample, 0) + value
+        lines = []
+        for name, (kind, samples) in families.items():
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(f"{sample} {format_value(value)}" for sample, value in samples.items())
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, "w") as fh:
+            fh.write("\n".join(lines) + "\n")
+        os.replace(temporary_path, path)
+
+
+def write_json_lines(registry, path, command=None):
+    record = dict(registry.snapshot(), time=time.time(), pid=os.getpid(), command=command)
+    with open(path, "a") as fh:
+        fh.write(json.dumps(record) + "\n")
+
+
+def write(registry, path, command=None):
+    if path.endswith(".prom"):
+        write_prometheus(registry, path)
+    else:
+        write_json_lines(registry, path, command=command)
+
+
+_registry = None
+
+
+def enable():
+    global _registry
+    _registry = profiling.add_sink(Registry())
+    return _registry
+
+
+def inc(name, value=1, **labels):
+    if _registry is not None:
+        _registry.inc(name, value, **labels)
+
+
+def gauge(name, value, **labels):
+    if _registry is not None:
+        _registry.set(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    if _registry is not None:
+        _registry.observe(name, value, **labels)
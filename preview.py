@@ -0,0 +1,206 @@
+import base64
+import fcntl
+import functools
+import importlib.util
+import io
+import os
+import re
+import select
+import struct
+import sys
+import termios
+import tty
+
+import profiling
+
+
+PROTOCOL_ENVIRONMENT = "BOOKSHELF_IMAGE_PROTOCOL"
+PROTOCOLS = ("kitty", "sixel", "blocks")
+CELL_SIZE = (10, 20)
+MAXIMUM_PIXELS = 1024
+SIXEL_COLORS = 256
+KITTY_CHUNK_SIZE = 4096
+QUERY_TIMEOUT = 0.2
+
+RESET = "\x1b[0m"
+CLEAR = "\x1b[H\x1b[2J"
+HALF_BLOCK = "▀"
+
+
+class Unsupported(Exception):
+    pass
+
+
+def terminal_size():
+    # Columns and rows, along with the size in pixels when the terminal reports it (zero otherwise).
+    try:
+        rows, columns, width, height = struct.unpack("HHHH", fcntl.ioctl(sys.stdout.fileno(), termios.TIOCGWINSZ,
+                                                                         b"\0" * 8))
+    except OSError:
+        raise Unsupported()
+    if not rows or not columns:
+        raise Unsupported()
+    return columns, rows, width, height
+
+
+def query(sequence, terminator):
+    fd = sys.stdin.fileno()
+    attributes = termios.tcgetattr(fd)
+    response = b""
+    try:
+        tty.setcbreak(fd, termios.TCSANOW)
+        sys.stdout.write(sequence)
+        sys.stdout.flush()
+        while not response.endswith(terminator):
+            ready, _, _ = select.select([fd], [], [], QUERY_TIMEOUT)
+            if not ready:
+                break
+            response += os.read(fd, 64)
+    finally:
+        termios.tcsetattr(fd, termios.TCSANOW, attributes)
+    return response
+
+
+@functools.lru_cache(maxsize=None)
+def protocol():
+    # Worked out once per process. Kitty (and the terminals that copied it) say so in the environment; sixel support
+    # is feature 4 in the primary device attributes.
+    override = os.environ.get(PROTOCOL_ENVIRONMENT)
+    if override in PROTOCOLS:
+        return override
+    if not sys.stdin.isatty() or not sys.stdout.isatty():
+        raise Unsupported()
+    if "KITTY_WINDOW_ID" in os.environ or "kitty" in os.environ.get("TERM", "") or \
+            os.environ.get("TERM_PROGRAM") in ("WezTerm", "ghostty"):
+        return "kitty"
+    attributes = query("\x1b[c", b"c")
+    match = re.search(rb"\x1b\[\?([0-9;]*)c", attributes)
+    if match and b"4" in match.group(1).split(b";"):
+        return "sixel"
+    return "blocks"
+
+
+@functools.lru_cache(maxsize=16)
+def decode(path, version):
+    # `version` is only there so the cache notices the file changing. Covers are scaled down here, once, so every
+    # later render starts from something small.
+    from PIL import Image
+    with Image.open(path) as image:
+        image = image.convert("RGB")
+    image.thumbnail((MAXIMUM_PIXELS, MAXIMUM_PIXELS))
+    return image
+
+
+def fit(image, width, height):
+    scale = min(width / image.width, height / image.height)
+    return max(1, int(image.width * scale)), max(1, int(image.height * scale))
+
+
+def render_blocks(image, columns, rows):
+    # Each cell shows two pixels: the upper half block in the foreground colour over the lower one in the background.
+    from PIL import Image
+    width, height = fit(image, columns, (rows - 1) * 2)
+    image = image.resize((width, height + height % 2), Image.LANCZOS)
+    pixels = image.load()
+    lines = []
+    for y in range(0, image.height, 2):
+        line = []
+        previous = None
+        for x in range(image.width):
+            colors = (pixels[x, y], pixels[x, y + 1])
+            if colors != previous:
+                (r, g, b), (R, G, B) = colors
+                line.append(f"\x1b[38;2;{r};{g};{b};48;2;{R};{G};{B}m")
+                previous = colors
+            line.append(HALF_BLOCK)
+        line.append(RESET)
+        lines.append("".join(line))
+    return "\n".join(lines) + "\n"
+
+
+def pixel_size(columns, rows, width, height):
+    if not width or not height:
+        return columns * CELL_SIZE[0], rows * CELL_SIZE[1]
+    return width, height
+
+
+def render_sixel(image, columns, rows, width, height):
+    import numpy
+    from PIL import Image
+    width, height = pixel_size(columns, rows, width, height)
+    cell_height = height / rows
+    image = image.resize(fit(image, width, height - cell_height), Image.LANCZOS)
+    image = image.quantize(colors=SIXEL_COLORS)
+    palette = image.getpalette()[:SIXEL_COLORS * 3]
+    indexes = numpy.asarray(image, dtype=numpy.int16)
+    # Sixels are six pixel tall bands, so pad the bottom out to a whole band with a colour that's never drawn.
+    padding = -len(indexes) % 6
+    indexes = numpy.vstack([indexes, numpy.full((padding, image.width), -1, dtype=numpy.int16)])
+    weights = (1 << numpy.arange(6, dtype=numpy.uint8))[:, None]
+
+    output = [f"\x1bPq\"1;1;{image.width};{image.height}"]
+    for index in range(len(palette) // 3):
+        r, g, b = (round(value * 100 / 255) for value in palette[index * 3:index * 3 + 3])
+        output.append(f"#{index};2;{r};{g};{b}")
+    for top in range(0, len(indexes), 6):
+        band = indexes[top:top + 6]
+        lines = []
+        for color in numpy.unique(band):
+            if color < 0:
+                continue
+            sixels = (((band == color) * weights).sum(axis=0) + 63).astype(numpy.uint8).tobytes()
+            sixels = re.sub(rb"(.)\1{3,}", lambda match: b"!%d%s" % (len(match.group(0)), match.group(1)), sixels)
+            lines.append(f"#{color}" + sixels.decode("ascii"))
+        output.append("$".join(lines) + "-")
+    output.append("\x1b\\")
+    return "".join(output) + "\n"
+
+
+def render_kitty(image, columns, rows, width, height):
+    # The terminal does the scaling; it only needs telling how many cells to cover.
+    width, height = pixel_size(columns, rows, width, height)
+    cell_width, cell_height = width / columns, height / rows
+    image_width, image_height = fit(image, width, height - cell_height)
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", compress_level=1)
+    payload = base64.standard_b64encode(buffer.getvalue()).decode("ascii")
+    size = f"c={max(1, round(image_width / cell_width))},r={max(1, round(image_height / cell_height))}"
+    chunks = [payload[index:index + KITTY_CHUNK_SIZE] for index in range(0, len(payload), KITTY_CHUNK_SIZE)]
+    output = []
+    for index, chunk in enumerate(chunks):
+        more = 1 if index < len(chunks) - 1 else 0
+        control = f"a=T,f=100,{size},m={more}" if index == 0 else f"m={more}"
+        output.append(f"\x1b_G{control};{chunk}\x1b\\")
+    return "".join(output) + "\n"
+
+
+@functools.lru_cache(maxsize=64)
+def render(path, version, protocol, columns, rows, width, height):
+    image = decode(path, version)
+    if protocol == "kitty":
+        return render_kitty(image, columns, rows, width, height)
+    elif protocol == "sixel":
+        return render_sixel(image, columns, rows, width, height)
+    return render_blocks(image, columns, rows)
+
+
+@profiling.traced("preview.show")
+def show(path):
+    # Raises Unsupported when there's no terminal to draw on, or no Pillow to draw with.
+    if importlib.util.find_spec("PIL") is None:
+        raise Unsupported()
+    details = os.stat(path)
+    current_protocol = protocol()
+    try:
+        output = render(os.path.realpath(path), (details.st_mtime_ns, details.st_size), current_protocol,
+                        *terminal_size())
+    except (OSError, ValueError):
+        # Not something Pillow can read; perhaps the external viewers can.
+        raise Unsupported()
+    sys.stdout.write(CLEAR + output)
+    sys.stdout.flush()
+    input("Press any key to continue...")
+    if current_protocol == "kitty":
+        sys.stdout.write("\x1b_Ga=d\x1b\\")
+    sys.stdout.write(CLEAR)
+    sys.stdout.flush()
@@ -0,0 +1,104 @@
+import collections
+import functools
+import json
+import os
+import threading
+import time
+
+
+class Tracer(object):
+
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+
+    def record(self, name, start, end, args):
+        event = {
+            "name": name,
+            "cat": "bookshelf",
+            "ph": "X",
+            "ts": (start - self.origin) * 1000000,
+            "dur": (end - start) * 1000000,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": args,
+        }
+        with self.lock:
+            self.events.append(event)
+
+    def write(self, path):
+        with open(path, "w") as fh:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, fh)
+
+    def summary(self):
+        durations = collections.defaultdict(list)
+        for event in self.events:
+            durations[event["name"]].append(event["dur"] / 1000.0)
+        lines = [f"{'Span':32}{'Count':>8}{'Total (ms)':>14}{'Mean (ms)':>14}{'Max (ms)':>14}"]
+        for name, values in sorted(durations.items(), key=lambda item: sum(item[1]), reverse=True):
+            lines.append(f"{name[:31]:32}{len(values):8}{sum(values):14.2f}{sum(values) / len(values):14.2f}"
+                         f"{max(values):14.2f}")
+        return "\n".join(lines)
+
+
+class Span(object):
+
+    __slots__ = ("name", "args", "start")
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter()
+        if exc_type is not None:
+            self.args = dict(self.args, error=exc_type.__name__)
+        for sink in _sinks:
+            sink.record(self.name, self.start, end, self.args)
+
+
+class NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+# Everything that wants to hear about finished spans: the tracer, and the metrics registry (see metrics.py).
+_sinks = []
+
+
+def add_sink(sink):
+    _sinks.append(sink)
+    return sink
+
+
+def enable():
+    return add_sink(Tracer())
+
+
+def span(name, **args):
+    if not _sinks:
+        return NULL_SPAN
+    return Span(name, args)
+
+
+def traced(name):
+    def decorator(function):
+        @functools.wraps(function)
+        def inner(*args, **kwargs):
+            if not _sinks:
+                return function(*args, **kwargs)
+            with Span(name, {}):
+                return function(*args, **kwargs)
+        return inner
+    return decorator
@@ -0,0 +1,98 @@
+import json
+
+import numpy
+
+import books
+
+
+STATUSES = list(books.Status)
+STATUS_INDEXES = {status: index for index, status in enumerate(STATUSES)}
+
+
+def dates(values):
+    # Dates are either ISO 8601 strings or, for older entries, values YAML has already parsed; both start with the
+    # calendar date, so the day is all we need to hand to NumPy.
+    return numpy.array([str(value)[:10] if value is not None else "NaT" for value in values], dtype="datetime64[D]")
+
+
+class Columns(object):
+
+    def __init__(self, library):
+        self.status = numpy.fromiter((STATUS_INDEXES[book.status] for book in library),
+                                     dtype=numpy.int8,
+                                     count=len(library))
+        self.date = dates([book.date for book in library])
+        self.end_date = dates([book.end_date for book in library])
+
+    def has_status(self, *statuses):
+        return numpy.isin(self.status, [STATUS_INDEXES[status] for status in statuses])
+
+
+def grouped_counts(keys):
+    groups, counts = numpy.unique(keys, return_counts=True)
+    return {str(group): int(count) for group, count in zip(groups, counts)}
+
+
+def finished_per_month(columns):
+    mask = columns.has_status(books.Status.READ) & ~numpy.isnat(columns.end_date)
+    return grouped_counts(columns.end_date[mask].astype("datetime64[M]"))
+
+
+def days_to_finish(columns):
+    mask = columns.has_status(books.Status.READ) & ~numpy.isnat(columns.date) & ~numpy.isnat(columns.end_date)
+    durations = (columns.end_date[mask] - columns.date[mask]).astype(numpy.int64)
+    if not len(durations):
+        return {"average": None, "by_year": {}}
+    years, inverse = numpy.unique(columns.end_date[mask].astype("datetime64[Y]"), return_inverse=True)
+    totals = numpy.bincount(inverse, weights=durations)
+    counts = numpy.bincount(inverse)
+    return {
+        "average": float(durations.mean()),
+        "by_year": {str(year): float(total / count) for year, total, count in zip(years, totals, counts)},
+    }
+
+
+def abandon_rate(columns):
+    # Abandoned books don't always have an end date, so fall back to the date they were started.
+    finished = numpy.where(numpy.isnat(columns.end_date), columns.date, columns.end_date)
+    mask = columns.has_status(books.Status.READ, books.Status.ABANDONED) & ~numpy.isnat(finished)
+    years, inverse = numpy.unique(finished[mask].astype("datetime64[Y]"), return_inverse=True)
+    abandoned = numpy.bincount(inverse, weights=columns.has_status(books.Status.ABANDONED)[mask], minlength=len(years))
+    counts = numpy.bincount(inverse, minlength=len(years))
+    return {str(year): float(total / count) for year, total, count in zip(years, abandoned, counts)}
+
+
+def summarize(library):
+    columns = Columns(library)
+    return {
+        "books": len(library),
+        "shelves": {status.value[1]: int(count)
+                    for status, count in zip(STATUSES, numpy.bincount(columns.status, minlength=len(STATUSES)))},
+        "finished_per_month": finished_per_month(columns),
+        "days_to_finish": days_to_finish(columns),
+        "abandon_rate": abandon_rate(columns),
+    }
+
+
+def print_table(title, rows):
+    print(title)
+    print()
+    if not rows:
+        print("  (none)")
+    for key, value in rows.items():
+        if isinstance(value, float):
+            value = f"{value:.2f}"
+        print(f"  {key:24}{value}")
+    print()
+
+
+def print_summary(summary, format="table"):
+    if format == "json":
+        print(json.dumps(summary, indent=4))
+        return
+    print(f"Books: {summary['books']}\n")
+    print_table("Shelves", summary["shelves"])
+    print_table("Finished per month", summary["finished_per_month"])
+    print_table("Average days to finish", {"All": summary["days_to_finish"]["average"] or 0.0,
+                                           **summary["days_to_finish"]["by_year"]})
+    print_table("Abandon rate by year", summary["abandon_rate"])
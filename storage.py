@@ -0,0 +1,394 @@
+import concurrent.futures
+import json
+import os
+import socket
+import subprocess
+import tempfile
+
+import books
+import codec
+import locking
+import metrics
+import profiling
+import utilities
+
+
+DATABASE_NAME = "library.sqlite"
+SOCKET_PATH = os.path.expanduser("~/.config/bookshelf/daemon.sock")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS books (
+    path TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    authors TEXT NOT NULL,
+    ids TEXT NOT NULL,
+    status TEXT,
+    date TEXT,
+    end_date TEXT,
+    thumbnail TEXT,
+    metadata TEXT,
+    content TEXT NOT NULL,
+    markdown TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS books_title ON books (title);
+CREATE INDEX IF NOT EXISTS books_status ON books (status);
+"""
+
+
+def version(stat):
+    return (stat.st_mtime_ns, stat.st_size) if stat is not None else None
+
+
+def stat(path):
+    try:
+        return os.stat(path)
+    except FileNotFoundError:
+        return None
+
+
+def resolve(path, base, document, current):
+    # `current` is the stored copy of a book that's about to be saved, and `base` what it was when it was loaded; if
+    # someone else has saved it in the meantime, their changes are merged with ours rather than overwritten.
+    if current is None or books.is_unchanged(current, base):
+        return document
+    try:
+        return books.merge(base, document, current)
+    except books.ConflictError as e:
+        raise books.ConflictError(f"'{path}' changed after it was loaded: {e}")
+
+
+def saved(book, document):
+    book.document = document
+    book.base = books.snapshot(document)
+
+
+class MarkdownStorage(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = locking.library_lock(directory)
+        self.quarantined = []
+
+    def load(self):
+        self.quarantined = []
+        with self.lock.shared():
+            library = books.load(self.directory, quarantine=self.quarantined)
+        for book in library:
+            book.storage = self
+        return measured(self, library)
+
+    def write(self, path, document):
+        with self.lock.exclusive():
+            codec.write(path, document)
+
+    def write_many(self, documents):
+        with self.lock.exclusive():
+            for path, document in documents:
+                codec.write(path, document)
+
+    def current(self, book):
+        # Files whose stat hasn't changed since they were loaded are taken as unchanged without reading them.
+        if book.stat is None:
+            return None
+        current_stat = stat(book.path)
+        if current_stat is None or version(current_stat) == version(book.stat):
+            return None
+        return codec.load(book.path)
+
+    def save_book(self, book):
+        document = resolve(book.path, book.base, book.document, self.current(book))
+        codec.write(book.path, document)
+        saved(book, document)
+        book.stat = os.stat(book.path)
+
+    def save(self, book):
+        with self.lock.exclusive():
+            self.save_book(book)
+
+    @profiling.traced("storage.save_many")
+    def save_many(self, books):
+        with self.lock.exclusive():
+            for book in books:
+                self.save_book(book)
+
+    def delete(self, book):
+        with self.lock.exclusive():
+            if os.path.exists(book.path):
+                os.remove(book.path)
+
+    def edit(self, book):
+        subprocess.check_call([os.environ['EDITOR'], book.path])
+
+
+def measured(library_storage, library):
+    metrics.gauge("bookshelf_library_books", len(library), library=library_storage.directory)
+    metrics.gauge("bookshelf_library_quarantined", len(library_storage.quarantined), library=library_storage.directory)
+    return library
+
+
+def text(value):
+    return str(value) if value is not None else None
+
+
+def json_metadata(metadata):
+    # JSON is much quicker to parse than YAML, but it can't represent the dates YAML parses from unquoted
+    # timestamps, so those books are loaded from their Markdown instead.
+    try:
+        encoded = json.dumps(metadata, sort_keys=True)
+    except TypeError:
+        return None
+    return encoded if json.loads(encoded) == metadata else None
+
+
+def edit_copy(book):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, os.path.basename(book.path))
+        codec.write(path, book.document)
+        subprocess.check_call([os.environ['EDITOR'], path])
+        book.document = codec.load(path)
+
+
+class SQLiteStorage(object):
+
+    def __init__(self, directory, path=None):
+        self.directory = directory
+        self.path = path or os.path.join(directory, DATABASE_NAME)
+        # Libraries are loaded on worker threads when there are several of them (see MultiStorage); access is never
+        # concurrent, so the connection can safely move between threads.
+        import sqlite3
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+        self.lock = locking.library_lock(directory)
+        self.quarantined = []
+
+    def key(self, path):
+        return os.path.relpath(path, self.directory)
+
+    def row(self, path, document, markdown=None):
+        metadata = document.metadata
+        if markdown is None:
+            markdown = codec.dumps(document) + "\n"
+        return (self.key(path),
+                metadata.get("title", ""),
+                json.dumps(metadata.get("authors", [])),
+                json.dumps({key: text(value) for key, value in metadata.get("ids", {}).items()}),
+                metadata.get("status"),
+                text(metadata.get("date")),
+                text(metadata.get("end_date")),
+                metadata.get("thumbnail"),
+                json_metadata(metadata),
+                document.content,
+                markdown)
+
+    def insert(self, rows):
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO books VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def document(self, metadata, content, markdown):
+        if metadata is not None:
+            return utilities.Document(content=content, metadata=json.loads(metadata))
+        return codec.loads(markdown)
+
+    @profiling.traced("storage.load")
+    def load(self):
+        library = []
+        self.quarantined = []
+        with self.lock.shared():
+            rows = self.connection.execute("SELECT path, metadata, content, markdown FROM books").fetchall()
+        for path, metadata, content, markdown in rows:
+            path = os.path.join(self.directory, path)
+            try:
+                book = books.Book(path, document=self.document(metadata, content, markdown), storage=self)
+                books.validate(book)
+            except books.LOAD_ERRORS as e:
+                self.quarantined.append((path, str(e) or e.__class__.__name__))
+                continue
+            library.append(book)
+        return measured(self, sorted(library, key=lambda x: x.title))
+
+    def write(self, path, document):
+        with self.lock.exclusive():
+            self.insert([self.row(path, document)])
+
+    def write_many(self, documents):
+        with self.lock.exclusive():
+            self.insert([self.row(path, document) for path, document in documents])
+
+    def current(self, book):
+        row = self.connection.execute("SELECT metadata, content, markdown FROM books WHERE path = ?",
+                                      (self.key(book.path),)).fetchone()
+        return self.document(*row) if row is not None else None
+
+    def save(self, book):
+        self.save_many([book])
+
+    @profiling.traced("storage.save_many")
+    def save_many(self, books):
+        with self.lock.exclusive():
+            documents = [resolve(book.path, book.base, book.document, self.current(book)) for book in books]
+            self.insert([self.row(book.path, document) for book, document in zip(books, documents)])
+        for book, document in zip(books, documents):
+            saved(book, document)
+
+    def delete(self, book):
+        with self.lock.exclusive(), self.connection:
+            self.connection.execute("DELETE FROM books WHERE path = ?", (self.key(book.path),))
+
+    def edit(self, book):
+        edit_copy(book)
+        self.save(book)
+
+    def import_markdown(self, directory=None):
+        directory = directory or self.directory
+        rows = []
+        for entry in books.scan(directory):
+            with open(entry.path) as fh:
+                markdown = fh.read()
+            path = os.path.join(self.directory, os.path.relpath(entry.path, directory))
+            rows.append(self.row(path, codec.loads(markdown), markdown=markdown))
+        self.insert(rows)
+        return len(rows)
+
+    def export_markdown(self, directory=None):
+        directory = directory or self.directory
+        count = 0
+        for path, markdown in self.connection.execute("SELECT path, markdown FROM books"):
+            destination = os.path.join(directory, path)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            with open(destination, "w") as fh:
+                fh.write(markdown)
+            count += 1
+        return count
+
+
+class DaemonError(Exception):
+    pass
+
+
+def encode_document(document):
+    if json_metadata(document.metadata) is not None:
+        return {"metadata": document.metadata, "content": document.content}
+    return {"markdown": codec.dumps(document)}
+
+
+def decode_document(record):
+    if "markdown" in record:
+        return codec.loads(record["markdown"])
+    return utilities.Document(content=record["content"], metadata=record["metadata"])
+
+
+class RemoteStorage(object):
+
+    def __init__(self, directory, path=SOCKET_PATH):
+        self.directory = directory
+        self.path = path
+        self.quarantined = []
+
+    def request(self, method, **arguments):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.connect(self.path)
+            with connection.makefile("rwb") as fh:
+                fh.write(json.dumps(dict(arguments, method=method)).encode("utf-8") + b"\n")
+                fh.flush()
+                response = json.loads(fh.readline())
+        if "error" in response:
+            if response.get("type") == "ConflictError":
+                raise books.ConflictError(response["error"])
+            raise DaemonError(response["error"])
+        return response["result"]
+
+    def is_running(self):
+        try:
+            self.request("ping")
+            return True
+        except (OSError, ValueError):
+            return False
+
+    @profiling.traced("storage.load")
+    def load(self):
+        library = [books.Book(record["path"], document=decode_document(record), storage=self)
+                   for record in self.request("list")]
+        self.quarantined = [tuple(item) for item in self.request("quarantined")]
+        return measured(self, library)
+
+    def write(self, path, document):
+        self.request("update", path=path, document=encode_document(document))
+
+    def write_many(self, documents):
+        self.request("update_many", books=[{"path": path, "document": encode_document(document)}
+                                           for path, document in documents])
+
+    def save(self, book):
+        self.save_many([book])
+
+    @profiling.traced("storage.save_many")
+    def save_many(self, books):
+        # The daemon merges with anything saved since these books were loaded, so pass along what they were then.
+        records = self.request("update_many", books=[{"path": book.path,
+                                                      "document": encode_document(book.document),
+                                                      "base": encode_document(book.base)}
+                                                     for book in books])
+        for book, record in zip(books, records):
+            saved(book, decode_document(record))
+
+    def delete(self, book):
+        self.request("delete", path=book.path)
+
+    def edit(self, book):
+        edit_copy(book)
+        self.save(book)
+
+
+BACKENDS = {
+    "markdown": MarkdownStorage,
+    "sqlite": SQLiteStorage,
+}
+
+
+def open_library(config):
+    # A running daemon already has the library loaded, so use it rather than reading everything from disk again.
+    socket_path = config.get("daemon_socket")
+    if socket_path is not None and os.path.exists(socket_path):
+        remote = RemoteStorage(config["library_path"], path=socket_path)
+        if remote.is_running():
+            return remote
+    return BACKENDS[config.get("storage", "markdown")](config["library_path"])
+
+
+class MultiStorage(object):
+    # Several libraries shown as one. Books remember the library they came from, and everything that changes a book
+    # goes back through that library's own storage.
+
+    def __init__(self, libraries):
+        self.libraries = libraries
+        self.quarantined = []
+
+    @profiling.traced("storage.load_all")
+    def load(self):
+        # Each library waits on its own disk, database or daemon, so they're loaded side by side.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.libraries)) as executor:
+            libraries = list(executor.map(lambda library: library[1].load(), self.libraries))
+        merged = []
+        self.quarantined = []
+        for (name, library_storage), library in zip(self.libraries, libraries):
+            for book in library:
+                book.library = name
+            merged.extend(library)
+            self.quarantined.extend(library_storage.quarantined)
+        return sorted(merged, key=lambda x: x.title)
+
+    def save(self, book):
+        book.storage.save(book)
+
+    def delete(self, book):
+        book.storage.delete(book)
+
+    def edit(self, book):
+        book.storage.edit(book)
+
+
+def open_libraries(libraries):
+    # `libraries` is a list of library configurations; a single library is used directly.
+    if len(libraries) == 1:
+        return open_library(libraries[0])
+    return MultiStorage([(library["name"], open_library(library)) for library in libraries])
@@ -1,24 +1,28 @@
 #!/usr/bin/env python3
 
 import argparse
-import collections
 import json
 import os
 import re
 import sys
 import webbrowser
 
-import frontmatter
 import pick
 import requests
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import books
+import catalog
+import isbns
 import openlibrary
+import storage
+import utilities
 
 
 BOOKS_DIRECTORY = "~/Projects/jbmorley.co.uk/content/about/books/"
 
-
-Document = collections.namedtuple("Document", ["content", "metadata"])
+ISBN_LOOKUP = isbns.Lookup(catalog=catalog.Catalog())
 
 class Book(object):
 
@@ -186,19 +190,14 @@ def google_interactive(query, details, accept_single_result=False):
 
 
 def google_books_by_isbn(isbn):
-    books = google_books(query=isbn)
-    book = books[0]
-    try:
-        if book.isbn == isbn:
-            return book
-    except KeyError:
-        pass
-    try:
-        if book.isbn_13 == isbn:
-            return book
-    except KeyError:
-        pass
-    raise BookNotFound
+    # The same checked, cached `isbn:` lookup the add book search uses, rather than a free text search for the number.
+    normalized = isbns.normalize(isbn)
+    if normalized is None:
+        raise BookNotFound
+    volumes = ISBN_LOOKUP.volumes(normalized)
+    if len(volumes) != 1:
+        raise BookNotFound
+    return Book(volumes[0].record)
 
 
 def main():
@@ -207,23 +206,25 @@ def main():
     options = parser.parse_args()
 
     directory = os.path.expanduser(BOOKS_DIRECTORY)
+    # Saving through the storage notices books edited since they were read here, and merges rather than overwriting.
+    library_storage = storage.MarkdownStorage(directory)
 
     files = [os.path.join(directory, f) for f in os.listdir(os.path.expanduser(BOOKS_DIRECTORY))
              if re.match(r"^[0-9]+\.md$", f)]
 
     for f in files:
-        book = frontmatter.load(f)
-        title = book.metadata['title']
-        author = book.metadata['authors'][0] if book.metadata["authors"] else ""
+        book = books.Book(f, stat=os.stat(f), storage=library_storage)
+        title = book.document.metadata['title']
+        author = book.document.metadata['authors'][0] if book.document.metadata["authors"] else ""
 
         sys.stdout.write(f"{title}, {author}... ")
         sys.stdout.flush()
         new_book = None
-        if "google_books" in book.metadata["ids"]:
+        if "google_books" in book.document.metadata["ids"]:
             sys.stdout.write(f"skipping\n")
             sys.stdout.flush()
             continue
-        if "isbn" not in book.metadata and "isbn_13" not in book.metadata:
+        if "isbn" not in book.document.metadata and "isbn_13" not in book.document.metadata:
             sys.stdout.write(f"interactive search\n")
             sys.stdout.flush()
             query = f"{title} {author}"
@@ -232,17 +233,17 @@ def main():
             except BookNotFound:
                 pass
         else:
-            isbn = book.metadata["isbn_13"] if "isbn_13" in book.metadata else book.metadata["isbn"]
+            isbn = book.document.metadata["isbn_13"] if "isbn_13" in book.document.metadata else book.document.metadata["isbn"]
             sys.stdout.write(f"ISBN {isbn}\n")
             sys.stdout.flush()
             if new_book is None:
                 try:
-                    new_book = google_books_by_isbn(isbn=book.metadata["isbn_13"])
+                    new_book = google_books_by_isbn(isbn=book.document.metadata["isbn_13"])
                 except (KeyError, BookNotFound):
                     pass
             if new_book is None:
                 try:
-                    new_book = google_books_by_isbn(isbn=book.metadata["isbn"])
+                    new_book = google_books_by_isbn(isbn=book.document.metadata["isbn"])
                 except (KeyError, BookNotFound):
                     pass
             if new_book is None:
@@ -252,21 +253,21 @@ def main():
             print(f"Unable to find '{title}'")
             continue
 
-        metadata = new_book.metadata
-        metadata['ids']['goodreads'] = book.metadata['ids']['goodreads']
-        metadata['status'] = book.metadata['status']
+        metadata = new_book.document.metadata
+        metadata['ids']['goodreads'] = book.document.metadata['ids']['goodreads']
+        metadata['status'] = book.document.metadata['status']
 
         # Preserve the dates.
-        if "date" in book.metadata:
-            metadata["date"] = book.metadata["date"]
-        if "end_date" in book.metadata:
-            metadata["end_date"] = book.metadata["end_date"]
+        if "date" in book.document.metadata:
+            metadata["date"] = book.document.metadata["date"]
+        if "end_date" in book.document.metadata:
+            metadata["end_date"] = book.document.metadata["end_date"]
 
         # Preserve ISBNs if they're somehow missing in the OpenLibrary.
-        if "isbn" not in metadata and "isbn" in book.metadata:
-            metadata["isbn"] = book.metadata["isbn"]
-        if "isbn_13" not in metadata and "isbn_13" in book.metadata:
-            metadata["isbn_13"] = book.metadata["isbn_13"]
+        if "isbn" not in metadata and "isbn" in book.document.metadata:
+            metadata["isbn"] = book.document.metadata["isbn"]
+        if "isbn_13" not in metadata and "isbn_13" in book.document.metadata:
+            metadata["isbn_13"] = book.document.metadata["isbn_13"]
 
         # Download the image.
         if new_book.thumbnail is not None:
@@ -277,10 +278,11 @@ def main():
                         fh.write(chunk)
 
         # Write the markdown file.
-        contents = frontmatter.dumps(Document(content="", metadata=metadata))
-        with open(f, "w") as fh:
-            fh.write(contents)
-            fh.write("\n")
+        book.document = utilities.Document(content=book.document.content, metadata=metadata)
+        try:
+            book.save()
+        except books.ConflictError as e:
+            print(f"Unable to save '{title}': {e}")
 
 
 if __name__ == "__main__":
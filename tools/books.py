@@ -5,15 +5,18 @@ import datetime
 import json
 import os
 import re
+import sys
 import webbrowser
 import collections
 
 import dateutil.tz
-import frontmatter
 import pick
 import pytz
 import requests
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import codec
 import openlibrary
 
 
@@ -30,7 +33,9 @@ def safe_basename(title):
 
 
 def main():
-    parser = argparse.ArgumentParser(description="Create a new book entry")
+    parser = argparse.ArgumentParser(description="Create a new book entry",
+                                     epilog="Open Library search results list one row per work, described by the "
+                                            "edition that best matches the search, rather than one per ISBN.")
     options = parser.parse_args()
 
     query = input("Search: ")
@@ -48,9 +53,7 @@ def main():
         metadata["end_date"] = date
 
     destination = os.path.expanduser(BOOKS_DIRECTORY)
-    with open(os.path.join(destination, f"{selected.basename}.md"), "w") as fh:
-        fh.write(frontmatter.dumps(Document(content="", metadata=metadata)))
-        fh.write("\n")
+    codec.write(os.path.join(destination, f"{selected.basename}.md"), Document(content="", metadata=metadata))
 
 
 if __name__ == "__main__":
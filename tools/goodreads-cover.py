@@ -1,18 +1,50 @@
 import argparse
 import os
+import sys
 
-import lxml.html
-import requests
+import yaml
 
-import utilities
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import batch
+import goodreads
+import storage
+
+
+CONFIG_PATH = os.path.expanduser("~/.config/bookshelf/config.yaml")
+
+
+def load_config():
+    with open(CONFIG_PATH) as fh:
+        config = yaml.safe_load(fh)
+    config["library_path"] = os.path.expanduser(config["library_path"])
+    return config
 
 
 def main():
     parser = argparse.ArgumentParser(description="Download the cover for a Goodreads book")
-    parser.add_argument("url", help="Goodreads URL")
+    parser.add_argument("url", nargs="?", help="Goodreads URL")
+    parser.add_argument("--batch", action="store_true", default=False,
+                        help="download covers for every book in the library with a Goodreads ID and no cover")
+    parser.add_argument("--jobs", "-j", type=int, default=4, help="number of concurrent downloads")
+    parser.add_argument("--rate", type=float, default=1.0, help="maximum Goodreads page requests per second")
+    parser.add_argument("--cache", default=goodreads.CACHE_DIRECTORY, help="directory for cached Goodreads pages")
     options = parser.parse_args()
-    utilities.download_goodreads_cover(url=options.url, basename="cover")
+
+    client = goodreads.Client(cache_directory=options.cache, rate=options.rate, workers=options.jobs)
+    if options.batch:
+        library_storage = storage.open_library(load_config())
+        counts = batch.print_results(goodreads.download_covers(library_storage,
+                                                               library_storage.load(),
+                                                               client,
+                                                               jobs=options.jobs))
+        if counts["failed"]:
+            exit(1)
+    elif options.url is not None:
+        goodreads.download_cover(client, url=options.url, basename="cover")
+    else:
+        parser.error("either a URL or --batch is required")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -7,10 +7,35 @@ import pick
 import requests
 import titlecase
 
+import catalog
+
+
+SEARCH_URL = "https://openlibrary.org/search.json"
+COVER_URL = "https://covers.openlibrary.org/b/id/{}-L.jpg"
+PAGE_SIZE = 20
+PREFETCH = 5
+
+# Only what SearchResult reads: the work's title and author names, and the edition that best matches the query.
+SEARCH_FIELDS = ",".join(["key", "title", "subtitle", "author_name", "format", "editions", "editions.key",
+                          "editions.title", "editions.subtitle", "editions.isbn", "editions.cover_i",
+                          "editions.format"])
+
 
 NewAuthor = collections.namedtuple("NewAuthor", ["name"])
 
 
+_catalog = None
+
+
+def record(books):
+    global _catalog
+    if _catalog is None:
+        _catalog = catalog.Catalog()
+    _catalog.record("open_library", [(book.key, book.full_title, [author.name for author in book.authors], book.isbn,
+                                      book.isbn_13, book.cover_url, book._dictionary)
+                                     for book in books])
+
+
 class Book(object):
 
     def __init__(self, isbn):
@@ -24,6 +49,7 @@ class Book(object):
             self._dictionary = response.json()[key]
         except json.decoder.JSONDecodeError:
             raise KeyError(isbn)
+        record([self])
 
     def get(self, key, default):
         try:
@@ -65,11 +91,17 @@ class Book(object):
         except KeyError:
             return None
 
+    @property
+    def cover_url(self):
+        try:
+            return self._dictionary["cover"]["large"]
+        except KeyError:
+            return None
+
     @property
     def authors(self):
         if "authors" not in self._dictionary:
             return []
-        # return [Author(author["key"]) for author in self._dictionary["authors"]]
         return [NewAuthor(name=author["name"]) for author in self._dictionary["authors"]]
 
     @property
@@ -120,35 +152,60 @@ class Book(object):
         return metadata
 
 
-class Cache(object):
-
-    def __init__(self):
-        self._results = {}
+class SearchResult(Book):
+    # A work from the search results, described by its best matching edition, all from the search response itself
+    # rather than a request per edition and per author.
 
-    def get(self, url):
-        if url not in self._results:
-            response = requests.get(url)
-            self._results[url] = response.json()
-        return self._results[url]
-
-
-cache = Cache()
-
-
-class Author(object):
-
-    def __init__(self, key):
-        url = f"https://openlibrary.org{key}.json"
-        self._data = cache.get(url)
+    def __init__(self, doc):
+        editions = doc.get("editions", {}).get("docs", [])
+        edition = editions[0] if editions else {}
+        isbns = edition.get("isbn", [])
+        formats = edition.get("format") or doc.get("format") or []
+        self._dictionary = {
+            "key": edition.get("key", doc["key"]),
+            "title": edition.get("title", doc["title"]),
+            "authors": [{"name": name} for name in doc.get("author_name", [])],
+        }
+        subtitle = edition.get("subtitle") if edition else doc.get("subtitle")
+        if subtitle is not None:
+            self._dictionary["subtitle"] = subtitle
+        for key, length in (("isbn_10", 10), ("isbn_13", 13)):
+            values = [isbn for isbn in isbns if len(isbn) == length]
+            if values:
+                self._dictionary[key] = values
+        if "cover_i" in edition:
+            self._dictionary["covers"] = [edition["cover_i"]]
+            self._dictionary["cover"] = {"large": COVER_URL.format(edition["cover_i"])}
+        if formats:
+            self._dictionary["physical_format"] = formats[0]
+
+
+class Results(object):
+    # Search results fetched a page at a time, as the picker gets near the end of what's already loaded.
+
+    def __init__(self, params, page_size=PAGE_SIZE):
+        self.params = params
+        self.page_size = page_size
+        self.books = []
+        self.found = None
 
     @property
-    def name(self):
-        return self._data["name"]
+    def more(self):
+        return self.found is None or len(self.books) < self.found
 
+    def fetch(self):
+        response = requests.get(SEARCH_URL, params=dict(self.params, fields=SEARCH_FIELDS, limit=self.page_size,
+                                                        offset=len(self.books)))
+        response_data = response.json()
+        books = [SearchResult(doc) for doc in response_data["docs"]]
+        self.found = response_data["numFound"] if books else len(self.books)
+        self.books.extend(books)
+        if books:
+            record(books)
+        return books
 
-def search(query=None, title=None, author=None):
-    # TODO: Check if it's better to search by ISBN 13
 
+def search(query=None, title=None, author=None):
     params = {}
     if query is not None:
         params["q"] = query
@@ -156,21 +213,27 @@ def search(query=None, title=None, author=None):
         params["title"] = title
     if author is not None:
         params["author"] = author
+    results = Results(params)
+    results.fetch()
+    return results
 
-    response = requests.get("http://openlibrary.org/search.json", params=params)
-    results = []
-    for doc in response.json()["docs"][:3]:
-        try:
-            isbns = doc["isbn"]
-            results.extend(isbns)
-        except KeyError:
-            pass
-    return [Book(isbn) for isbn in results]
+
+class ResultsPicker(pick.Picker):
+
+    def __init__(self, results, *args, **kwargs):
+        # The picker shares the results' list, so pages fetched later show up in it.
+        super(ResultsPicker, self).__init__(results.books, *args, **kwargs)
+        self.results = results
+
+    def move_down(self):
+        if self.index + PREFETCH >= len(self.options) - 1 and self.results.more:
+            self.results.fetch()
+        super(ResultsPicker, self).move_down()
 
 
 def interactive_search(query=None, title=None, author=None):
-    books = search(query=query, title=title, author=author)
-    if not books:
+    results = search(query=query, title=title, author=author)
+    if not results.books:
         raise KeyError(query)
 
     def summary(book):
@@ -189,7 +252,8 @@ def interactive_search(query=None, title=None, author=None):
     def skip(picker):
         return None, -1
 
-    picker = pick.Picker(books, "Select edition ('v' to view, 's' to skip):", indicator='*', options_map_func=summary)
+    picker = ResultsPicker(results, "Select book ('v' to view, 's' to skip):", indicator='*',
+                           options_map_func=summary)
     picker.register_custom_handler(ord('v'),  show_webpage)
     picker.register_custom_handler(ord('s'),  skip)
     selected, index = picker.start()
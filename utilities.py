@@ -1,4 +1,5 @@
 import collections
+import concurrent.futures
 import curses
 import datetime
 import json
@@ -6,11 +7,12 @@ import os
 import re
 import string
 import subprocess
-import webbrowser
 
 import dateutil.tz
 import pick
-import requests
+
+import metrics
+import profiling
 
 
 Document = collections.namedtuple("Document", ["content", "metadata"])
@@ -89,10 +91,13 @@ class Command(object):
 
     def __init__(self, command):
         self.command = command
+        self.path = None
 
     def run(self, arguments):
-        command = which(self.command)
-        if command is None:
+        if self.path is None:
+            self.path = which(self.command) or ""
+        command = self.path
+        if not command:
             raise CommandNotFound
         subprocess.check_call([command] + arguments)
 
@@ -123,8 +128,13 @@ class CommandSet(object):
 PREVIEW_IMAGE_COMMAND = CommandSet(Wait(Command("termimage")), Command("open"))
 
 
+@profiling.traced("utilities.preview_image")
 def preview_image(path):
-    PREVIEW_IMAGE_COMMAND.run([path])
+    import preview
+    try:
+        preview.show(path)
+    except preview.Unsupported:
+        PREVIEW_IMAGE_COMMAND.run([path])
 
 
 def set_escdelay(delay):
@@ -135,12 +145,49 @@ def tznow():
     return datetime.datetime.now().replace(tzinfo=dateutil.tz.tzlocal())
 
 
+def timestamp(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        try:
+            value = datetime.datetime.fromisoformat(value)
+        except ValueError:
+            import dateutil.parser
+            value = dateutil.parser.isoparse(value)
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime.combine(value, datetime.time())
+    return int(value.timestamp())
+
+
 def download_image(url, destination):
-    r = requests.get(url, stream=True)
-    if r.status_code == 200:
+    import requests
+    with profiling.span("utilities.download_image", url=url):
+        try:
+            r = requests.get(url, stream=True)
+        except requests.exceptions.ConnectionError:
+            metrics.inc("bookshelf_cover_downloads_total", result="connection-error")
+            return False
+        if r.status_code != 200:
+            metrics.inc("bookshelf_cover_downloads_total", result=f"http-{r.status_code}")
+            return False
         with open(destination, 'wb') as fh:
             for chunk in r:
                 fh.write(chunk)
+        metrics.inc("bookshelf_cover_downloads_total", result="ok")
+        return True
+
+
+def bounded_map(function, items, workers=8):
+    # Results come back in order with at most a couple of batches' worth of work in flight, so arbitrarily long
+    # streams of items are processed in constant memory.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        for item in items:
+            pending.append(executor.submit(function, item))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
 
 
 def basename(name):